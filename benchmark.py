@@ -0,0 +1,180 @@
+# Reproducible benchmarks for the game engine and the trainer.
+#
+#   python benchmark.py --output bench.json
+#   python benchmark.py --baseline bench.json
+#
+# Every number comes from fixed seeds, so two runs on the same machine
+# measure the same work. With --baseline the run is compared to a stored
+# result and the exit code is 1 if any number got worse than --tolerance.
+import argparse
+import contextlib
+import io
+import json
+import platform
+import statistics
+import sys
+import timeit
+
+import genetic_algo as ga
+
+SEEDS = [11, 23, 37, 41, 59]
+# boards the search and feature benchmarks run on, taken from these games
+BOARDS_PER_SEED = 40
+# timed samples per benchmark, each one runs the benchmark as many times as
+# it takes to fill timeit's autorange (at least 0.2 seconds)
+REPEATS = 7
+# a train() generation is long enough on its own
+TRAIN_REPEATS = 5
+# allowed relative change before compare() flags a regression. Runs of
+# the same code on a shared single core VM differed by up to 45%, a quiet
+# machine can use a much smaller --tolerance
+TOLERANCE = 0.5
+
+# name -> True if higher is better
+METRICS = {
+    "placements_per_second": True,
+    "decisions_per_second": True,
+    "pieces_per_second": True,
+    "batched_pieces_per_second": True,
+    "feature_us_per_board": False,
+    "all_features_us_per_board": False,
+    "train_generation_seconds": False,
+}
+
+# median seconds per call of function over repeats samples
+def _median_time(function, repeats = REPEATS):
+    timer = timeit.Timer(function)
+    (number, elapsed) = timer.autorange()
+    return statistics.median(elapsed / number for elapsed in timer.repeat(repeats, number))
+
+def _reference_gene():
+    return ga.Gene(False)
+
+# the game right before each of the first BOARDS_PER_SEED pieces
+def sample_games():
+    gene = _reference_gene()
+    games = []
+    for seed in SEEDS:
+        game = ga.Game(seed, movement_log = 0)
+        for i in range(BOARDS_PER_SEED):
+            if game.is_game_over:
+                break
+            games.append(game.clone())
+            best = ga.get_best_placement(game, gene)
+            game.place(best.rotation, best.x)
+    return games
+
+def bench_search(games):
+    gene = _reference_gene()
+    placements = sum(len(ga.get_placements(game)) for game in games)
+    def run():
+        for game in games:
+            ga.get_best_moves(game, gene)
+    elapsed = _median_time(run)
+    return {"placements_per_second": placements / elapsed,
+            "decisions_per_second": len(games) / elapsed}
+
+def bench_features(games):
+    boards = [game.get_rows() for game in games]
+    def run():
+        for rows in boards:
+            ga.get_features(rows)
+    def run_all():
+        for rows in boards:
+            ga.extract_features(rows)
+    return {"feature_us_per_board": _median_time(run) / len(boards) * 1e6,
+            "all_features_us_per_board": _median_time(run_all) / len(boards) * 1e6}
+
+def bench_game():
+    gene = _reference_gene()
+    pieces = [0]
+    def run():
+        pieces[0] = 0
+        for seed in SEEDS:
+            pieces[0] += ga.play_game(gene, seed)[0]
+    elapsed = _median_time(run)
+    return {"pieces_per_second": pieces[0] / elapsed}
+
+def bench_batched():
+    weights = ga.population_weights([_reference_gene()] * len(SEEDS))
+    pieces = [0]
+    def run():
+        batch = ga.GameBatch(SEEDS)
+        pieces[0] = int(batch.run(weights)[0].sum())
+    elapsed = _median_time(run)
+    return {"batched_pieces_per_second": pieces[0] / elapsed}
+
+def bench_train():
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            ga.train(workers = 1, seed = SEEDS[0], generations = 1)
+    # train draws from the global random module, keep it out of the way
+    state = ga.rnd.getstate()
+    elapsed = _median_time(run, TRAIN_REPEATS)
+    ga.rnd.setstate(state)
+    return {"train_generation_seconds": elapsed}
+
+def run_benchmarks(include_train = True):
+    games = sample_games()
+    results = {}
+    results.update(bench_search(games))
+    results.update(bench_features(games))
+    results.update(bench_game())
+    results.update(bench_batched())
+    if include_train:
+        results.update(bench_train())
+    return {"python": platform.python_version(),
+            "machine": platform.machine(),
+            "boards": len(games),
+            "seeds": SEEDS,
+            "metrics": results}
+
+# (name, baseline, current, change) for every metric worse than tolerance,
+# change is the relative difference in the "worse" direction
+def compare(baseline, current, tolerance):
+    regressions = []
+    for name, higher_is_better in METRICS.items():
+        if name not in baseline["metrics"] or name not in current["metrics"]:
+            continue
+        old = baseline["metrics"][name]
+        new = current["metrics"][name]
+        # nothing to measure a relative change against
+        if old == 0:
+            continue
+        if higher_is_better:
+            change = (old - new) / old
+        else:
+            change = (new - old) / old
+        if change > tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "benchmark the tetris engine and trainer")
+    parser.add_argument("--output", help = "write the results as json to this file")
+    parser.add_argument("--baseline", help = "json results to compare against")
+    parser.add_argument("--tolerance", type = float, default = TOLERANCE,
+                        help = "allowed relative slowdown before flagging a regression")
+    parser.add_argument("--no-train", action = "store_true", help = "skip the train() generation")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(not args.no_train)
+    for name, value in results["metrics"].items():
+        print("%-28s %14.2f" % (name, value))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.tolerance)
+        for (name, old, new, change) in regressions:
+            print("REGRESSION %s: %.2f -> %.2f (%.0f%% worse)" % (name, old, new, 100 * change))
+        if regressions:
+            return 1
+        print("no regressions against " + args.baseline)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,36 @@
 import random as rnd
 from enum import Enum
-import msvcrt
+try:
+    import msvcrt
+except ImportError:
+    # not on windows, main() reads the keyboard with termios instead
+    msvcrt = None
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = None
+import select
 import time 
 import os
 import copy
 import sys
-import traceback
 import cProfile
+import multiprocessing
+from array import array
+import functools
+import contextlib
+import concurrent.futures
+import json
+import tempfile
+import struct
+import socket
+import socketserver
+import threading
+import asyncio
+import stat
+from collections import deque, OrderedDict
+import numpy as np
 
 GENERATIONS = 20
 POPULATION_SIZE = 10
@@ -22,7 +46,51 @@ FITTEST_RATIO = 0.3
 EMPTY = " "
 BLOCK = "0"
 
-TEST_GAMES = 100
+# every row of the grid is an int bitmask, bit x set means cell x is a block
+FULL_ROW = (1 << GRID_WIDTH) - 1
+
+# games every gene plays per generation, all genes get the same pieces
+TEST_GAMES = 10
+MAX_PIECES = 300
+# how seeded games deal pieces, "uniform" or "bag" (7-bag)
+SEQUENCE = "uniform"
+
+# how many of the last movements a Game remembers for move_back, 0 keeps none
+MOVEMENT_LOG = 1000
+
+# look at next_piece too when choosing a placement, only the BEAM_WIDTH best
+# placements of the current piece are tried with every next piece placement.
+# The defaults of every lookahead, beam_width and time_budget argument, read
+# when called
+LOOKAHEAD = False
+BEAM_WIDTH = 6
+# seconds a lookahead decision may take, None for no limit
+DECISION_BUDGET = None
+
+# boards + pieces whose placements play_games remembers per process, 0 for
+# no cache
+PLACEMENT_CACHE_SIZE = 0
+
+# play the games of a generation in rounds of RACE_ROUND games and stop
+# playing genes that can't make the elite any more. A gene is dropped when
+# the upper end of its lines per piece interval (pooled score / pieces +-
+# RACE_Z standard errors) is under the lower end of the worst elite gene.
+# Dropped genes rank after the ones that played every game
+RACING = False
+RACE_ROUND = 2
+RACE_Z = 2.0
+
+# genes picked at random for every parent in train_steady_state, the best
+# of them breeds
+TOURNAMENT_SIZE = 3
+
+# where train(checkpoint_dir = ...) puts the best gene of every generation
+BEST_GENE_FILE = "best_gene.json"
+
+# processes used by train() to play games, 1 plays them in this process
+WORKERS = 1
+# play a generation's games together in one GameBatch instead
+BATCHED = False
 
 DEBUG = False
 
@@ -30,6 +98,85 @@ def printd(_str):
     if (DEBUG):
         print(_str)
 
+#****************** STATS STUFF ***************************
+# counters and timers for the hot paths. They are only collected while
+# INSTRUMENT is set (see enable_stats), when off they cost a global lookup
+
+INSTRUMENT = False
+# run train() and ai_play() under cProfile and dump its stats to this file
+PROFILE_FILE = None
+
+class Stats:
+    counters = ["placements", "clones", "collision_checks", "line_clears", "locks"]
+    # score_seconds is part of search_seconds
+    timers = ["search_seconds", "score_seconds", "simulation_seconds"]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.values = dict.fromkeys(Stats.counters + Stats.timers, 0)
+
+    def snapshot(self):
+        return dict(self.values)
+
+    # what was collected since snapshot
+    def since(self, snapshot):
+        return {name: self.values[name] - snapshot[name] for name in self.values}
+
+    def merge(self, values):
+        for name in values:
+            self.values[name] += values[name]
+
+STATS = Stats()
+# where emit_stats writes, None for stdout
+_stats_file = None
+
+def enable_stats(path = None):
+    global INSTRUMENT, _stats_file
+    INSTRUMENT = True
+    _stats_file = path
+
+def disable_stats():
+    global INSTRUMENT
+    INSTRUMENT = False
+
+# one json object per line
+def emit_stats(record):
+    line = json.dumps(record)
+    if _stats_file is None:
+        print(line)
+    else:
+        with open(_stats_file, "a") as f:
+            f.write(line + "\n")
+
+# adds the time spent in the function to a Stats timer
+def timed(timer):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENT:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                STATS.values[timer] += time.perf_counter() - start
+        return wrapper
+    return decorator
+
+def profiled(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if PROFILE_FILE is None:
+            return function(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            profile.dump_stats(PROFILE_FILE)
+    return wrapper
+
 
 #****************** GAME STUFF ****************************
 
@@ -54,27 +201,29 @@ class Coordinate:
     def __str__(self):
         return "Coordinate x: " + str(self.x) + " y: " + str(self.y)
 
-class Matrix():
-    def __init__(self, x, y):
-        self.t_x = x
-        self.t_y = y
-
-    def __str__(self):
-        return str((("t_x and t_y " + str((self.t_x, self.t_y)))))
-
-    def inv_transform(self, coordinate):
-        return Coordinate(coordinate.x - self.t_x, coordinate.y - self.t_y)
-
-    def transform(self, coordinate):
-        return Coordinate(coordinate.x + self.t_x, coordinate.y + self.t_y)
-
-    def translate(self, coordinate):
-        self.t_x += coordinate.x
-        self.t_y += coordinate.y
-
-    def translate_t(self, tuple):
-        self.t_x += tuple[0]
-        self.t_y += tuple[1]
+class Orientation:
+    def __init__(self, shape, offset):
+        self.shape  = shape
+        self.width  = len(shape[0])
+        self.height = len(shape)
+        self.cells  = []
+        for dy in range(self.height):
+            for dx in range(self.width):
+                if shape[dy][dx] == BLOCK:
+                    self.cells.append((dx, dy))
+        self.masks = []
+        for row in shape:
+            mask = 0
+            for dx in range(len(row)):
+                if row[dx] == BLOCK:
+                    mask |= 1 << dx
+            self.masks.append(mask)
+        # lowest block of every column, what a drop lands on
+        self.bottom = [max(dy for (x, dy) in self.cells if x == dx) for dx in range(self.width)]
+        self.top    = [min(dy for (x, dy) in self.cells if x == dx) for dx in range(self.width)]
+        self.row_counts = [bin(mask).count("1") for mask in self.masks]
+        # where the top left corner sits relative to the unrotated piece
+        self.offset = offset
 
 class Shape:
     I = "I"
@@ -97,83 +246,82 @@ class Shape:
                     ["0", "0", "0"],],
                S : [["0", "0", " "],
                     [" ", "0", "0"]],
-               S_2 : [["", "0", "0"],
+               S_2 : [[" ", "0", "0"],
                     ["0", "0", " "]],
                 }
 
-    def __init__(self, shapeID):
-        self.rotations = 0
-        self.shape   = self.shapes[shapeID]
-        self.shapeID = shapeID
-        self.anchor_point = Coordinate(0,0)
-        self.matrix = Matrix(0,0)
-        
-        if shapeID == self.I:
-            self.anchor_point = Coordinate(0, 1)
-        elif shapeID == self.O:
-            self.anchor_point = Coordinate(0, 0)
-        elif shapeID == self.L:
-            self.anchor_point = Coordinate(1, 1)
-        elif shapeID == self.L_2:
-            self.anchor_point = Coordinate(1, 1)
-        elif shapeID == self.T:
-            self.anchor_point = Coordinate(1, 1)
-        elif shapeID == self.S:
-            self.anchor_point = Coordinate(1, 1)
-        elif shapeID == self.S_2:
-            self.anchor_point = Coordinate(1, 1)
+    anchors = { I : Coordinate(0, 1),
+                O : Coordinate(0, 0),
+                L : Coordinate(1, 1),
+                L_2 : Coordinate(1, 1),
+                T : Coordinate(1, 1),
+                S : Coordinate(1, 1),
+                S_2 : Coordinate(1, 1),
+                }
+
+    # filled in below the class, shapeID -> the 4 clockwise Orientations
+    orientations = {}
+
+    __slots__ = ("shapeID", "rotation", "x", "y")
+
+    def __init__(self, shapeID, rotation = 0, x = 0, y = 0):
+        self.shapeID  = shapeID
+        self.rotation = rotation
+        self.x = x
+        self.y = y
+
+    def copy(self):
+        return Shape(self.shapeID, self.rotation, self.x, self.y)
+
+    def orientation(self):
+        return Shape.orientations[self.shapeID][self.rotation]
+
+    @property
+    def shape(self):
+        return self.orientation().shape
+
+    @property
+    def rotations(self):
+        return self.rotation
 
     def rotate(self, rotation = ROTATION.CLOCKWISE):
         if rotation == ROTATION.CLOCKWISE:
-            self.rotations += 1
-            if self.rotations == 37:
-                traceback.print_stack()
+            self.turn_to((self.rotation + 1) % 4)
         elif rotation == ROTATION.COUNTER_CLOCKWISE:
-            self.rotations -= 1
+            self.turn_to((self.rotation - 1) % 4)
         else:
             assert(False)
 
-        diff_anchor = Coordinate(self.anchor_point.y - self.anchor_point.x, self.anchor_point.x - self.anchor_point.y)
-        self.anchor_point = Coordinate(self.anchor_point.y, self.anchor_point.x)
-        rotated_shape = []
-        for y in range(len(self.shape[0])):
-            temp = []
-            for x in range(len(self.shape)):
-                temp.append(self.shape[x][y])
-            if rotation == ROTATION.CLOCKWISE:
-                temp.reverse()
-            rotated_shape.append(temp)
-        if rotation == ROTATION.COUNTER_CLOCKWISE:
-            rotated_shape.reverse()
-        self.shape = rotated_shape
-        self.matrix.translate(diff_anchor)
+    # same position as rotating there one step at a time
+    def turn_to(self, new_rotation):
+        old = Shape.orientations[self.shapeID][self.rotation].offset
+        new = Shape.orientations[self.shapeID][new_rotation].offset
+        self.x += new.x - old.x
+        self.y += new.y - old.y
+        self.rotation = new_rotation
     
     def width(self):
-        return len(self.shape[0])
+        return self.orientation().width
 
     def h_width(self):
         return int (0.5 * self.width())
 
     def height(self):
-        return len(self.shape)
+        return self.orientation().height
 
-    def get_random():
-        shape = Shape(list(Shape.shapes.keys())[rnd.randrange(len(Shape.shapes))])
-        for a in range(rnd.randrange(0,2)):
+    def get_random(rng = rnd):
+        shape = Shape(list(Shape.shapes.keys())[rng.randrange(len(Shape.shapes))])
+        for a in range(rng.randrange(0,2)):
             shape.rotate()
         return shape
 
     def get(self, x, y):
         assert(x >= 0 and x < self.width())
         assert(y >= 0 and y < self.height())
-        return self.shape[y][x]
-
-    def get_local(self, x, y):
-        (x, y) = self.matrix.inv_transform(x, y)
-        return self.get(x, y)
+        return BLOCK if (self.orientation().masks[y] >> x) & 1 else EMPTY
 
     def current_position(self):
-        return self.matrix.transform(Coordinate(0, 0))
+        return Coordinate(self.x, self.y)
 
     def print(self):
         for x in range(self.width()):
@@ -181,178 +329,522 @@ class Shape:
                 print(self.get(x, y), end="")
             print()
 
+def _rotate_clockwise(shape):
+    rotated_shape = []
+    for y in range(len(shape[0])):
+        temp = []
+        for x in range(len(shape)):
+            temp.append(shape[x][y])
+        temp.reverse()
+        rotated_shape.append(temp)
+    return rotated_shape
+
+def _build_orientations():
+    for shapeID, shape in Shape.shapes.items():
+        anchor = Shape.anchors[shapeID]
+        offset = Coordinate(0, 0)
+        Shape.orientations[shapeID] = []
+        for rotation in range(4):
+            Shape.orientations[shapeID].append(Orientation(shape, offset))
+            # turning around the anchor point moves the top left corner
+            offset = Coordinate(offset.x + anchor.y - anchor.x, offset.y + anchor.x - anchor.y)
+            anchor = Coordinate(anchor.y, anchor.x)
+            shape = _rotate_clockwise(shape)
+
+_build_orientations()
+
+SHAPE_IDS = list(Shape.shapes.keys())
+
+# the pieces dealt to a game, one byte each: the index into SHAPE_IDS plus 8
+# when the piece spawns turned once. "uniform" draws every piece on its own
+# like Shape.get_random, "bag" deals all 7 pieces in a shuffled order before
+# dealing any of them again. Grows on demand, so any length can be asked for.
+# length and kind default to MAX_PIECES + 1 and SEQUENCE as they are when called
+class PieceSequence:
+    def __init__(self, seed, length = None, kind = None):
+        if length is None:
+            length = MAX_PIECES + 1
+        if kind is None:
+            kind = SEQUENCE
+        assert(kind == "uniform" or kind == "bag")
+        self.rng = rnd.Random(seed)
+        self.kind = kind
+        self.bag = []
+        self.pieces = array("B")
+        self.extend(length)
+
+    def extend(self, length):
+        while len(self.pieces) < length:
+            if self.kind == "bag":
+                if not self.bag:
+                    self.bag = list(range(len(SHAPE_IDS)))
+                    self.rng.shuffle(self.bag)
+                piece = self.bag.pop()
+            else:
+                piece = self.rng.randrange(len(SHAPE_IDS))
+            self.pieces.append(piece + 8 * self.rng.randrange(0,2))
+
+    def shape(self, i):
+        self.extend(i + 1)
+        shape = Shape(SHAPE_IDS[self.pieces[i] & 7])
+        if self.pieces[i] & 8:
+            shape.rotate()
+        return shape
+
+#****************** BOARD STUFF ***************************
+# a board is a list of GRID_HEIGHT row bitmasks, top row first
+
+def fits(rows, orientation, x, y):
+    if INSTRUMENT:
+        STATS.values["collision_checks"] += 1
+    if x < 0 or y < 0:
+        return False
+    if x + orientation.width > GRID_WIDTH or y + orientation.height > GRID_HEIGHT:
+        return False
+    for dy in range(orientation.height):
+        if rows[y + dy] & (orientation.masks[dy] << x):
+            return False
+    return True
+
+def place(rows, orientation, x, y):
+    rows = list(rows)
+    for dy in range(orientation.height):
+        rows[y + dy] |= orientation.masks[dy] << x
+    return rows
+
+# first filled row of every column, GRID_HEIGHT for an empty column
+def column_tops(rows):
+    tops = [GRID_HEIGHT] * GRID_WIDTH
+    covered = 0
+    for y in range(GRID_HEIGHT):
+        new = rows[y] & ~covered
+        while new:
+            low = new & -new
+            tops[low.bit_length() - 1] = y
+            new ^= low
+        covered |= rows[y]
+        if covered == FULL_ROW:
+            break
+    return tops
+
+def column_heights(rows):
+    return [GRID_HEIGHT - top for top in column_tops(rows)]
+
+def count_holes(rows):
+    count = 0
+    covered = 0
+    for row in rows:
+        count += bin(covered & ~row).count("1")
+        covered |= row
+    return count
+
+# row where a piece dropped straight down from (x, y) comes to rest
+def drop(rows, orientation, x, y, tops):
+    landing = GRID_HEIGHT
+    for dx in range(orientation.width):
+        landing = min(landing, tops[x + dx] - 1 - orientation.bottom[dx])
+    if landing >= y:
+        return landing
+    # the stack reaches above the piece, fall back to walking down
+    while fits(rows, orientation, x, y + 1):
+        y += 1
+    return y
+
+# ZOBRIST_ROWS[y][mask] is the xor of the random keys of the blocks of mask
+# at row y, the keys are fixed so hashes match between processes
+def _build_zobrist():
+    rng = rnd.Random(0x7e7215)
+    tables = []
+    for y in range(GRID_HEIGHT):
+        keys = [rng.getrandbits(64) for x in range(GRID_WIDTH)]
+        table = [0] * (FULL_ROW + 1)
+        for mask in range(1, FULL_ROW + 1):
+            low = mask & -mask
+            table[mask] = table[mask ^ low] ^ keys[low.bit_length() - 1]
+        tables.append(table)
+    return tables
+
+ZOBRIST_ROWS = _build_zobrist()
+
+def zobrist_hash(rows):
+    h = 0
+    for y in range(GRID_HEIGHT):
+        h ^= ZOBRIST_ROWS[y][rows[y]]
+    return h
+
+# every board feature is read from one BoardScan, a single top to bottom
+# pass over the rows. FEATURES maps a feature name to a function of the scan,
+# a new feature is registered with @feature and costs no extra pass
+
+FEATURES = OrderedDict()
+
+def feature(name):
+    def register(function):
+        FEATURES[name] = function
+        return function
+    return register
+
+# the features Game tracks without a scan and GameBatch computes
+BASE_FEATURES = ("aggregate_height", "full_lines", "holes", "bumpiness")
+
+# BIT_COUNTS[mask] is the number of bits set in a row mask with its walls
+BIT_COUNTS = [bin(mask).count("1") for mask in range(1 << (GRID_WIDTH + 2))]
+
+# rows are the board with piece locked in and its lines not cleared yet,
+# piece is only needed by the features of the placement itself
+class BoardScan:
+    __slots__ = ("rows", "piece", "heights", "holes", "full_lines", "row_transitions", "column_transitions", "wells")
+
+    def __init__(self, rows, piece = None):
+        self.rows = rows
+        self.piece = piece
+        tops = [GRID_HEIGHT] * GRID_WIDTH
+        # rows above the stack are empty, they only have the 2 wall transitions
+        y = 0
+        while y < GRID_HEIGHT and rows[y] == 0:
+            y += 1
+        holes = 0
+        full_lines = 0
+        row_transitions = 2 * y
+        column_transitions = 0
+        wells = 0
+        covered = 0
+        above = 0
+        # consecutive well cells down to every column, and the columns that
+        # had one in the row above
+        depth = [0] * GRID_WIDTH
+        in_well = 0
+        walls = (1 << (GRID_WIDTH + 1)) | 1
+        inside = (1 << (GRID_WIDTH + 1)) - 1
+        bit_counts = BIT_COUNTS
+        for y in range(y, GRID_HEIGHT):
+            row = rows[y]
+            new = row & ~covered
+            if new:
+                covered |= row
+                while new:
+                    low = new & -new
+                    tops[low.bit_length() - 1] = y
+                    new ^= low
+            holes += bit_counts[covered & ~row]
+            if row == FULL_ROW:
+                full_lines += 1
+            # bit x + 1 of walled is cell x, bits 0 and GRID_WIDTH + 1 the walls
+            walled = (row << 1) | walls
+            row_transitions += bit_counts[(walled ^ (walled >> 1)) & inside]
+            column_transitions += bit_counts[row ^ above]
+            above = row
+            # empty cells with a block or a wall on both sides
+            well = ~row & walled & (walled >> 2) & FULL_ROW
+            changed = well | in_well
+            while changed:
+                low = changed & -changed
+                x = low.bit_length() - 1
+                if well & low:
+                    depth[x] += 1
+                    wells += depth[x]
+                else:
+                    depth[x] = 0
+                changed ^= low
+            in_well = well
+        # the floor counts as blocks
+        column_transitions += bit_counts[above ^ FULL_ROW]
+        self.heights = [GRID_HEIGHT - top for top in tops]
+        self.holes = holes
+        self.full_lines = full_lines
+        self.row_transitions = row_transitions
+        self.column_transitions = column_transitions
+        self.wells = wells
+
+@feature("aggregate_height")
+def _aggregate_height(scan):
+    return sum(scan.heights)
+
+@feature("full_lines")
+def _full_lines(scan):
+    return scan.full_lines
+
+@feature("holes")
+def _holes(scan):
+    return scan.holes
+
+@feature("bumpiness")
+def _bumpiness(scan):
+    heights = scan.heights
+    bumpiness = 0
+    for x in range(GRID_WIDTH - 1):
+        bumpiness += abs(heights[x] - heights[x + 1])
+    return bumpiness
+
+@feature("max_height")
+def _max_height(scan):
+    return max(scan.heights)
+
+# cumulative well depth, a well 3 cells deep counts 1 + 2 + 3
+@feature("wells")
+def _wells(scan):
+    return scan.wells
+
+@feature("row_transitions")
+def _row_transitions(scan):
+    return scan.row_transitions
+
+@feature("column_transitions")
+def _column_transitions(scan):
+    return scan.column_transitions
+
+# height of the middle of the placed piece, counted from the floor
+@feature("landing_height")
+def _landing_height(scan):
+    if scan.piece is None:
+        return 0
+    return GRID_HEIGHT - scan.piece.y - 0.5 * (scan.piece.height() - 1)
+
+# lines the placed piece clears times its cells in them
+@feature("eroded_cells")
+def _eroded_cells(scan):
+    piece = scan.piece
+    if piece is None:
+        return 0
+    orientation = piece.orientation()
+    lines = 0
+    cells = 0
+    for dy in range(orientation.height):
+        if scan.rows[piece.y + dy] == FULL_ROW:
+            lines += 1
+            cells += orientation.row_counts[dy]
+    return lines * cells
+
+# the names features of rows, all registered features by default
+def extract_features(rows, names = None, piece = None):
+    scan = BoardScan(rows, piece)
+    if names is None:
+        names = FEATURES.keys()
+    return tuple(FEATURES[name](scan) for name in names)
+
+# (aggregate height, full lines, holes, bumpiness)
+def get_features(rows):
+    return extract_features(rows, BASE_FEATURES)
+
 class Game:
-    def __init__(self):
+    # pieces come from sequence, from PieceSequence(seed) or from the
+    # global random module when neither is given. A sequence can be shared
+    # by many games
+    def __init__(self, seed = None, movement_log = MOVEMENT_LOG, sequence = None):
+        if sequence is None and seed is not None:
+            sequence = PieceSequence(seed)
+        self.sequence = sequence
+        self.dealt = 0
         self.pieces = 1
         self.score = 0 
         self.iteration = 0
-        self.piece = Shape.get_random()
-        self.next_piece = Shape.get_random()
-        self.movements = []
+        self.piece = self._deal()
+        self.next_piece = self._deal()
+        self.movements = deque(maxlen = movement_log)
         self.score = 0
         self.is_game_over = False
-        self.grid = []
-        for y in range(GRID_HEIGHT):
-            self.grid.append([" "] * GRID_WIDTH)
+        # locked blocks only, the active piece is kept apart in self.piece
+        self.rows = [0] * GRID_HEIGHT
+        # set when rows and counters are shared with a clone
+        self._shared = False
+        self._refresh_features()
         
         assert(self._try_translate(self.get_start_pos(self.piece)))
         self._move_active_piece(self.get_start_pos(self.piece))
 
-    def print(self, show_piece = False):
-        to_print = ""
-        to_print += " "
-        for line in range(len(self.grid[GRID_HIDDEN:][0])):
-            to_print += "_"
-        to_print += "\n"
-        for line in self.grid[GRID_HIDDEN:]:
-            to_print += "|"
-            for _char in line:
-                to_print += _char
-            to_print += "|\n"
-
-        to_print += ("SCORE: " + str(self.score) + "\n")
-        to_print += ("Next piece\n")
+    # the lines print() shows, the board, the score and the next piece
+    def frame(self):
+        lines = [" " + "_" * self.width()]
+        for row in self.get_rows()[GRID_HIDDEN:]:
+            lines.append("|" + "".join(BLOCK if (row >> x) & 1 else EMPTY for x in range(self.width())) + "|")
+
+        lines.append("SCORE: " + str(self.score))
+        lines.append("Next piece")
         for x in range(self.next_piece.width()):
-            to_print += ("      ")
-            for y in range(self.next_piece.height()):
-                to_print += (self.next_piece.get(x, y))
-            to_print += "\n"
-        to_print += "-\n"
-        print (to_print)
+            lines.append("      " + "".join(self.next_piece.get(x, y) for y in range(self.next_piece.height())))
+        lines.append("-")
+        return lines
+
+    def print(self, show_piece = False):
+        print ("\n".join(self.frame()) + "\n")
+
+    @property
+    def grid(self):
+        grid = []
+        for row in self.get_rows():
+            grid.append([BLOCK if (row >> x) & 1 else EMPTY for x in range(GRID_WIDTH)])
+        return grid
 
     def get_shape(self, shapeID):
         return self.shapes[shapeID]
 
     def width(self):
-        return len(self.grid[0])
+        return GRID_WIDTH
 
     def height(self):
-        return len(self.grid)
+        return GRID_HEIGHT
+
+    # (y, mask) for every row the piece covers, masks already shifted to x
+    def piece_rows(self, piece):
+        return [(piece.y + dy, mask << piece.x) for dy, mask in enumerate(piece.orientation().masks)]
+
+    # locked rows with the active piece painted on top
+    def get_rows(self):
+        rows = list(self.rows)
+        if not self.is_game_over:
+            for y, mask in self.piece_rows(self.piece):
+                if y >= 0:
+                    rows[y] |= mask
+        return rows
 
     def delete_row(self, row_number):
         assert(row_number >= 0)
         assert(row_number < GRID_HEIGHT)
-        for y in reversed(range(1, row_number + 1)):
-            for x in range(self.width()):
-                self.set(x, y, self.get(x, y - 1))
+        self._own_rows()
+        del self.rows[row_number]
+        self.rows.insert(0, 0)
+        self._refresh_features()
 
     def detect_and_remove_rows(self):
-        is_filled = True
-        for y in range(self.height()):
-            is_filled = True
-            for x in range(self.width()):
-                if (self.get(x, y) == EMPTY):
-                    is_filled = False
-            if is_filled:
-                self.delete_row(y)
-                self.score += 1
-
-    def collides(self, copy_grid, p_piece):
-        for dx in range(p_piece.width()):
-            for dy in range(p_piece.height()):
-                pos = p_piece.matrix.transform(Coordinate(dx, dy))
-                if pos.x < 0:
-                    printd("too left")
-                    return False
-                if pos.y < 0:
-                    assert(False)
-                    return False
-                if pos.x >= GRID_WIDTH:
-                    printd("too right")
-                    return False
-                if pos.y >= GRID_HEIGHT:
-                    printd("too low")
-                    return False
-                if (p_piece.get(dx, dy) == BLOCK and copy_grid[pos.y][pos.x] == BLOCK):
-                    printd("another block")
-                    return False
-        return True
+        kept = [row for row in self.rows if row != FULL_ROW]
+        removed = GRID_HEIGHT - len(kept)
+        if removed > 0:
+            self.rows = [0] * removed + kept
+            self.score += removed
+            self._refresh_features()
+            if INSTRUMENT:
+                STATS.values["line_clears"] += removed
+
+    # returns true if the piece fits in rows (no wall, floor or block hit)
+    def collides(self, rows, p_piece):
+        return fits(rows, p_piece.orientation(), p_piece.x, p_piece.y)
 
     def get_grid_without_piece(self):
-        copy_grid = copy.deepcopy(self.grid)
-        for dx in range(self.piece.width()):
-            for dy in range(self.piece.height()):
-                pos = self.piece.matrix.transform(Coordinate(dx, dy))
-                if (self.piece.get(dx, dy) == BLOCK):
-                    copy_grid[pos.y][pos.x] = EMPTY
-        return copy_grid
+        return list(self.rows)
 
     def is_empty_line(self, y):
-        for x in range(self.width()):
-            if x == BLOCK:
-                return False
-        return True
+        return self.get_rows()[y] == 0
 
     def is_full_line(self, y):
-        for x in range(self.width()):
-            if self.get(x, y) == EMPTY:
-                return False
-        return True
+        return self.get_rows()[y] == FULL_ROW
 
     def get_clear_height(self):
         r = 0
-        for y in self.height():
-            if is_empty_line(y):
+        for row in self.get_rows():
+            if row == 0:
                 r += 1
             else:
                 return r
         return r
 
     def get_full_lines(self):
-        count = 0
-        for y in range(self.height()):
-            if self.is_full_line(y):
-                count += 1
-        return count
+        return self.get_rows().count(FULL_ROW)
 
     def get_holes(self):
-        count = 0;
-        for x in range(self.width()):
-            block = False;
-            for y in range(self.height()):
-                if self.get(x, y) == BLOCK:
-                    block = True
-                elif self.get(x, y) == EMPTY and block:
-                    count+=1
-        return count
+        return count_holes(self.get_rows())
 
+    def column_heights(self):
+        return column_heights(self.get_rows())
 
     def column_height(self, x):
-        r = 0
-        for y in range(self.height()):
-            if (self.get(x, y) == BLOCK):
-                break
-            else:
-                r+=1
-        return self.height() - r
+        return self.column_heights()[x]
     
     def get_aggregate_height(self):
-        total = 0
-        for x in range(self.width()):
-            total += self.column_height(x)
-        return total;
+        return sum(self.column_heights())
 
     def bumpiness(self):
-        total = 0;
-        for x in range(self.width() - 1):
-            total += abs(self.column_height(x) - self.column_height(x + 1));
-        return total;
+        return extract_features(self.get_rows(), ("bumpiness",))[0]
+
+    # features of the board with the active piece locked where it is
+    def get_features(self, names = BASE_FEATURES):
+        if self.is_game_over:
+            if names == BASE_FEATURES:
+                return self.base_features()
+            return extract_features(self.rows, names)
+        return self.placement_features(self.piece, names)
+
+    # rescan the locked rows, only needed after line clears and edits
+    def _refresh_features(self):
+        self.heights  = column_heights(self.rows)
+        self.row_fill = [bin(row).count("1") for row in self.rows]
+        self.holes    = count_holes(self.rows)
+        self.full_lines = self.row_fill.count(GRID_WIDTH)
+        self.board_hash = zobrist_hash(self.rows)
+
+    # column_tops of the locked rows, from the tracked heights
+    def column_tops(self):
+        return [GRID_HEIGHT - height for height in self.heights]
+
+    # get_features of the locked rows, from the tracked counters
+    def base_features(self):
+        heights = self.heights
+        bumpiness = 0
+        for x in range(GRID_WIDTH - 1):
+            bumpiness += abs(heights[x] - heights[x + 1])
+        return (sum(heights), self.full_lines, self.holes, bumpiness)
+
+    # what locking piece where it is would change in get_features, the
+    # board is left untouched
+    def feature_deltas(self, piece):
+        orientation = piece.orientation()
+        heights = self.heights
+        x = piece.x
+        y = piece.y
+        d_height = 0
+        d_holes = 0
+        d_bumpiness = 0
+        new_heights = []
+        for dx in range(orientation.width):
+            old = heights[x + dx]
+            bottom = y + orientation.bottom[dx]
+            if bottom < GRID_HEIGHT - old:
+                # everything between the piece and the stack gets covered
+                d_holes += GRID_HEIGHT - old - bottom - 1
+                new = GRID_HEIGHT - y - orientation.top[dx]
+            else:
+                # tucked under an overhang, it fills holes
+                d_holes -= orientation.bottom[dx] - orientation.top[dx] + 1
+                new = old
+            d_height += new - old
+            new_heights.append(new)
+        left = max(x - 1, 0)
+        right = min(x + orientation.width, GRID_WIDTH - 1)
+        for c in range(left, right):
+            h_1 = new_heights[c - x] if c >= x else heights[c]
+            h_2 = new_heights[c + 1 - x] if c + 1 < x + orientation.width else heights[c + 1]
+            d_bumpiness += abs(h_1 - h_2) - abs(heights[c] - heights[c + 1])
+        d_lines = 0
+        for dy in range(orientation.height):
+            if self.row_fill[y + dy] + orientation.row_counts[dy] == GRID_WIDTH:
+                d_lines += 1
+        return (d_height, d_lines, d_holes, d_bumpiness)
+
+    # BASE_FEATURES come from the tracked counters, anything else needs a
+    # BoardScan of the board with piece locked
+    def placement_features(self, piece, names = BASE_FEATURES):
+        if names != BASE_FEATURES:
+            return extract_features(place(self.rows, piece.orientation(), piece.x, piece.y), names, piece)
+        base = self.base_features()
+        deltas = self.feature_deltas(piece)
+        return (base[0] + deltas[0], base[1] + deltas[1], base[2] + deltas[2], base[3] + deltas[3])
+
+    # the _try_ functions move the piece in place, check and move it back
 
     def _try_rotate(self, rotation):
-        p_piece = copy.deepcopy(self.piece)
-        copy_grid = self.get_grid_without_piece()
-        p_piece.rotate(rotation)
-        return self.collides(copy_grid, p_piece);
+        self.piece.rotate(rotation)
+        fits = self.collides(self.rows, self.piece)
+        self.piece.rotate(ROTATION.COUNTER_CLOCKWISE if rotation == ROTATION.CLOCKWISE else ROTATION.CLOCKWISE)
+        return fits
 
     def _try_translate(self, diff):
-        p_piece   = copy.deepcopy(self.piece)
-        copy_grid = self.get_grid_without_piece()
-        p_piece.matrix.translate_t(diff)
+        self._move_active_piece(diff)
         # edges
-        return self.collides(copy_grid, p_piece);
+        fits = self.collides(self.rows, self.piece)
+        self._move_active_piece((-diff[0], -diff[1]))
+        return fits
 
     def get(self, x, y):
-        return self.grid[y][x]
+        return BLOCK if (self.get_rows()[y] >> x) & 1 else EMPTY
 
     def fset(self, x, y, stuff):
         if (y < 0):
@@ -360,7 +852,12 @@ class Game:
             # the I shape object if rotated might be over the top of the
             # grid
             return
-        self.grid[y][x] = stuff
+        self._own_rows()
+        if stuff == BLOCK:
+            self.rows[y] |= 1 << x
+        else:
+            self.rows[y] &= ~(1 << x)
+        self._refresh_features()
 
     def set(self, x, y, stuff):
         assert(stuff == EMPTY or stuff == BLOCK)
@@ -372,106 +869,72 @@ class Game:
             return
         assert(x < self.width())
         assert(y < self.height())
-        #if (stuff == EMPTY and x == 1 and (y == GRID_HEIGHT - 1)):
-        #    print(self.piece.matrix)
-        #    printd("trying to empty " + str(x) + " " + str(y))
-        #    traceback.print_stack()
-        #    self.grid[y][x] = "*"
-        #    self.print()
-        #    sys.exit()
-        self.grid[y][x] = stuff
-
-    def clear_active_piece(self):
-        #erase
-        for x in range(self.piece.width()):
-            for y in range(self.piece.height()):
-                t = self.piece.matrix.transform(Coordinate(x, y))
-                if (t.y < 0):
-                    pass
-                if (self.piece.get(x, y) == BLOCK):
-                    self.fset(t.x, t.y, EMPTY)
+        self.fset(x, y, stuff)
+
+    def lock_piece(self):
+        (d_height, d_lines, d_holes, d_bumpiness) = self.feature_deltas(self.piece)
+        self._own_rows()
+        orientation = self.piece.orientation()
+        for dx in range(orientation.width):
+            top = GRID_HEIGHT - self.piece.y - orientation.top[dx]
+            self.heights[self.piece.x + dx] = max(self.heights[self.piece.x + dx], top)
+        for dy in range(orientation.height):
+            y = self.piece.y + dy
+            row = self.rows[y] | (orientation.masks[dy] << self.piece.x)
+            self.board_hash ^= ZOBRIST_ROWS[y][self.rows[y]] ^ ZOBRIST_ROWS[y][row]
+            self.rows[y] = row
+            self.row_fill[y] += orientation.row_counts[dy]
+        self.holes += d_holes
+        self.full_lines += d_lines
 
     def clear(self):
-        for x in range(self.width()):
-            for y in range(self.height()):
-                self.fset(x, y, EMPTY)
-
-    def paint_piece(self, like=BLOCK):
-        for x in range(self.piece.width()):
-            for y in range(self.piece.height()):
-                t = self.piece.matrix.transform(Coordinate(x, y))
-                if (self.piece.get(x, y) == BLOCK):
-                    self.fset(t.x, t.y, like)
+        self.rows = [0] * GRID_HEIGHT
+        self._refresh_features()
 
     def _move_active_piece(self, diff):
-        #erase
-        self.clear_active_piece()
-        self.piece.matrix.translate_t(diff)
-        self.paint_piece()
+        self.piece.x += diff[0]
+        self.piece.y += diff[1]
 
     def _rotate_active_piece(self, rotation):
-        #erase
-        self.clear_active_piece()
         self.piece.rotate(rotation)
-        self.paint_piece()
 
     def reset(self):
-        self.grid = []
-        for y in range(GRID_HEIGHT):
-            self.grid.append([" "] * GRID_WIDTH)
+        self.clear()
 
-    def try_move(self, movement):
+    # moves the active piece without any check, direction -1 reverts it
+    def _apply(self, movement, direction = 1):
         if (movement == MOVEMENT.MOVE_LEFT):
-            return self._try_translate((-1,0))
+            self._move_active_piece((-direction, 0))
         elif (movement == MOVEMENT.MOVE_RIGHT):
-            return self._try_translate((1,0))
+            self._move_active_piece((direction, 0))
         elif (movement == MOVEMENT.MOVE_DOWN):
-            return self._try_translate((0,1))
+            self._move_active_piece((0, direction))
         elif (movement == MOVEMENT.ROTATE_CLOCKWISE):
-            return self._try_rotate(ROTATION.CLOCKWISE)
+            self.piece.rotate(ROTATION.CLOCKWISE if direction == 1 else ROTATION.COUNTER_CLOCKWISE)
         elif (movement == MOVEMENT.ROTATE_COUNTER_CLOCKWISE):
-            return self._try_rotate(ROTATION.COUNTER_CLOCKWISE)
+            self.piece.rotate(ROTATION.COUNTER_CLOCKWISE if direction == 1 else ROTATION.CLOCKWISE)
+
+    def _undo(self, movement):
+        self._apply(movement, -1)
+
+    def try_move(self, movement):
+        self._apply(movement)
+        fits = self.collides(self.rows, self.piece)
+        self._undo(movement)
+        return fits
     
     def move_back(self, amount=1):
         for i in range(amount):
-            movement = movements.pop()
-            if (movement == MOVEMENT.MOVE_LEFT):
-                assert(self._try_translate((1,0)))
-                self._move_active_piece((1,0))
-            elif (movement == MOVEMENT.MOVE_RIGHT):
-                assert(self._try_translate((-1,0)))
-                self._move_active_piece((-1,0))
-            elif (movement == MOVEMENT.MOVE_DOWN):
-                assert(self._try_translate((0,-1)))
-                self._move_active_piece((0,-1))
-            elif (movement == MOVEMENT.ROTATE_CLOCKWISE):
-                assert(self._try_rotate(ROTATION.COUNTER_CLOCKWISE))
-                self._rotate_active_piece(ROTATION.COUNTER_CLOCKWISE)
-            elif (movement == MOVEMENT.ROTATE_COUNTER_CLOCKWISE):
-                assert(self._try_rotate(ROTATION.CLOCKWISE))
-                self._rotate_active_piece(ROTATION.CLOCKWISE)
+            movement = self.movements.pop()
+            self._undo(movement)
+            assert(self.collides(self.rows, self.piece))
 
     def move(self, movement):
-        if (movement == MOVEMENT.MOVE_LEFT):
-            if(self._try_translate((-1,0))):
-                self.movements.append(MOVEMENT.MOVE_LEFT)
-                self._move_active_piece((-1,0))
-        elif (movement == MOVEMENT.MOVE_RIGHT):
-            if(self._try_translate((1,0))):
-                self.movements.append(MOVEMENT.MOVE_RIGHT)
-                self._move_active_piece((1,0))
-        elif (movement == MOVEMENT.MOVE_DOWN):
-            if(self._try_translate((0,1))):
-                self.movements.append(MOVEMENT.MOVE_DOWN)
-                self._move_active_piece((0,1))
-        elif (movement == MOVEMENT.ROTATE_CLOCKWISE):
-            if(self._try_rotate(ROTATION.CLOCKWISE)):
-                self.movements.append(MOVEMENT.ROTATE_CLOCKWISE)
-                self._rotate_active_piece(ROTATION.CLOCKWISE)
-        elif (movement == MOVEMENT.ROTATE_COUNTER_CLOCKWISE):
-            if(self._try_rotate(ROTATION.COUNTER_CLOCKWISE)):
-                self.movements.append(MOVEMENT.ROTATE_COUNTER_CLOCKWISE)
-                self._rotate_active_piece(ROTATION.COUNTER_CLOCKWISE)
+        self._apply(movement)
+        if self.collides(self.rows, self.piece):
+            self.movements.append(movement)
+        else:
+            self._undo(movement)
 
     def get_start_pos(self, piece):
         return (MID_WIDTH - self.piece.h_width(), GRID_HIDDEN)
@@ -480,105 +943,619 @@ class Game:
     def push_down_by_clock(self):
         #if can't move further down
         if (self._try_translate((0,1)) == False):
-            self.piece = copy.deepcopy(self.next_piece)
-            self.next_piece = Shape.get_random()
-            self.pieces += 1
-            self.detect_and_remove_rows()
-            #push down a lil bit the next piece
-            if (self._try_translate(self.get_start_pos(self.piece)) == False):
-                self.is_game_over = True
-            else:
-                self._move_active_piece(self.get_start_pos(self.piece))
+            self._lock_and_spawn()
             return True
         else:
             self._move_active_piece((0,1))
 
         return False
 
+    def _lock_and_spawn(self):
+        if INSTRUMENT:
+            STATS.values["locks"] += 1
+        self.lock_piece()
+        self.detect_and_remove_rows()
+        self._spawn(self.next_piece)
+        self.next_piece = self._deal()
+
+    def _deal(self):
+        if self.sequence is None:
+            return Shape.get_random()
+        self.dealt += 1
+        return self.sequence.shape(self.dealt - 1)
+
+    def _spawn(self, piece):
+        self.piece = piece
+        self.pieces += 1
+        #push down a lil bit the next piece
+        if (self._try_translate(self.get_start_pos(self.piece)) == False):
+            self.is_game_over = True
+        else:
+            self._move_active_piece(self.get_start_pos(self.piece))
+
+    # a clone with piece locked and next_piece brought in, nothing new is
+    # dealt so next_piece is left as it was
+    def preview(self, piece):
+        game = self.clone()
+        game.piece = piece.copy()
+        game.lock_piece()
+        game.detect_and_remove_rows()
+        game._spawn(self.next_piece.copy())
+        return game
+
+    # headless play: turns the active piece to rotation where it is, puts
+    # it at column x, hard drops and locks it and brings in the next piece,
+    # nothing is recorded. Returns (pieces, score, is_game_over)
+    @timed("simulation_seconds")
+    def place(self, rotation, x):
+        piece = self.piece
+        piece.turn_to(rotation)
+        piece.x = x
+        orientation = piece.orientation()
+        assert(fits(self.rows, orientation, x, piece.y))
+        piece.y = drop(self.rows, orientation, x, piece.y, self.column_tops())
+        self._lock_and_spawn()
+        return (self.pieces, self.score, self.is_game_over)
+
+    # rows and counters stay shared with the clone until one of them locks
+    # a piece or edits the grid
     def clone(self):
-        return copy.deepcopy(self)
+        if INSTRUMENT:
+            STATS.values["clones"] += 1
+        game = copy.copy(self)
+        game.piece = self.piece.copy()
+        game.next_piece = self.next_piece.copy()
+        game.movements = deque(self.movements, maxlen = self.movements.maxlen)
+        self._shared = True
+        game._shared = True
+        return game
+
+    def _own_rows(self):
+        if self._shared:
+            self.rows = list(self.rows)
+            self.heights = list(self.heights)
+            self.row_fill = list(self.row_fill)
+            self._shared = False
+
+#****************** BATCHED GAME STUFF ********************
+# many games stepped together with numpy, playing the same game as Game.place
+# on get_placements: pieces spawn turned as the PieceSequence says, only the
+# placements get_placements reaches from the spawn row are candidates and they
+# are tried in its order, so ties go the same way
+
+class GameBatch:
+    # indexed by piece code, filled in by _build_batch_tables. A candidate
+    # is a get_placements placement before the drop, a probe a position the
+    # piece must fit at for get_placements to reach a candidate
+    cand_valid  = None
+    cand_bottom = None
+    cand_top    = None
+    cand_cover  = None
+    cand_cells  = None
+    cand_counts = None
+    cand_rotation = None
+    cand_x      = None
+    # the row the candidate is dropped from and the height of its orientation
+    cand_y      = None
+    cand_height = None
+    # the probes that must fit, the spawn position is probe 0
+    cand_path   = None
+    probe_y     = None
+    probe_cells = None
+    # out of the grid, never fits
+    probe_never = None
+
+    def __init__(self, seeds, max_pieces = None, kind = None):
+        if max_pieces is None:
+            max_pieces = MAX_PIECES
+        n = len(seeds)
+        self.size = n
+        self.max_pieces = max_pieces
+        # the same piece codes Game(seed) deals
+        self.sequences = np.array([PieceSequence(seed, max_pieces + 1, kind).pieces[:max_pieces + 1] for seed in seeds], dtype=np.int8)
+        self.boards   = np.zeros((n, GRID_HEIGHT, GRID_WIDTH), dtype=bool)
+        self.heights  = np.zeros((n, GRID_WIDTH), dtype=np.int64)
+        self.row_fill = np.zeros((n, GRID_HEIGHT), dtype=np.int64)
+        self.holes    = np.zeros(n, dtype=np.int64)
+        self.pieces   = np.ones(n, dtype=np.int64)
+        self.score    = np.zeros(n, dtype=np.int64)
+        self.is_game_over = np.zeros(n, dtype=bool)
+
+    def active(self):
+        return np.flatnonzero(~self.is_game_over & (self.pieces < self.max_pieces))
+
+    # whether cells (games x ... x 4 x GRID_WIDTH) overlap no block of the
+    # boards of games idx from rows y on
+    def _clear_at(self, idx, cells, y):
+        rows = np.clip(y[..., None] + np.arange(4), 0, GRID_HEIGHT - 1)
+        board = self.boards[idx.reshape((-1,) + (1,) * (rows.ndim - 1)), rows]
+        return ~(board & cells).any(axis=(-2, -1))
+
+    # whether each probe of piece codes pid fits on the boards of games idx,
+    # probe 0 tells if the piece can spawn
+    def _probe_fits(self, idx, pid):
+        return self._clear_at(idx, self.probe_cells[pid], self.probe_y[pid]) & ~self.probe_never[pid]
+
+    # weights holds one weights() row per game, returns False once every
+    # game is over or out of pieces
+    def step(self, weights):
+        idx = self.active()
+        if len(idx) == 0:
+            return False
+        rng = np.arange(len(idx))
+        pid = self.sequences[idx, self.pieces[idx] - 1]
+
+        # reachable from the spawn position
+        blocked = ~self._probe_fits(idx, pid)
+        valid = self.cand_valid[pid] & ~(blocked[:, None, :] & self.cand_path[pid]).any(axis=2)
+
+        heights = self.heights[idx]
+        tops = GRID_HEIGHT - heights
+        bottom = self.cand_bottom[pid]
+        cover  = self.cand_cover[pid]
+        landing = (tops[:, None, :] - 1 - bottom).min(axis=2)
+        # the stack reaches above the piece, drop walks it down like drop()
+        start = self.cand_y[pid]
+        low = np.nonzero(valid & (landing < start))
+        if len(low[0]) > 0:
+            y = start[low]
+            cells = self.cand_cells[pid[low[0]], low[1]]
+            limit = GRID_HEIGHT - self.cand_height[pid[low[0]], low[1]]
+            falling = np.ones(len(y), dtype=bool)
+            while falling.any():
+                falling &= (y < limit) & self._clear_at(idx[low[0]], cells, y + 1)
+                y += falling
+            landing[low] = y
+
+        # feature_deltas: blocks under the piece become holes, a piece
+        # tucked under an overhang fills them
+        piece_bottom = landing[:, :, None] + bottom
+        above = cover & (piece_bottom < tops[:, None, :])
+        tucked = cover & ~above
+        new_heights = np.where(above, GRID_HEIGHT - landing[:, :, None] - self.cand_top[pid], heights[:, None, :])
+        gaps = (np.where(above, tops[:, None, :] - piece_bottom - 1, 0)
+                - np.where(tucked, bottom - self.cand_top[pid] + 1, 0)).sum(axis=2)
+        counts = self.cand_counts[pid]
+        piece_rows = np.clip(landing[:, :, None] + np.arange(4), 0, GRID_HEIGHT - 1)
+        fill = np.take_along_axis(self.row_fill[idx][:, None, :], piece_rows, axis=2)
+        lines = ((fill + counts == GRID_WIDTH) & (counts > 0)).sum(axis=2)
+        features = np.stack([new_heights.sum(axis=2),
+                             lines,
+                             self.holes[idx][:, None] + gaps,
+                             np.abs(np.diff(new_heights, axis=2)).sum(axis=2)], axis=2)
+        scores = np.einsum("acf,af->ac", features, weights[idx])
+        scores[~valid] = -np.inf
+        choice = scores.argmax(axis=1)
+
+        stuck = ~valid[rng, choice]
+        self.is_game_over[idx[stuck]] = True
+        keep = ~stuck
+        idx, pid, choice = idx[keep], pid[keep], choice[keep]
+        rng = rng[keep]
+
+        # lock
+        land = landing[rng, choice]
+        cells = self.cand_cells[pid, choice]
+        row_counts = counts[rng, choice]
+        for dy in range(4):
+            sel = row_counts[:, dy] > 0
+            self.boards[idx[sel], land[sel] + dy] |= cells[sel, dy]
+            self.row_fill[idx[sel], land[sel] + dy] += row_counts[sel, dy]
+        self.heights[idx] = new_heights[rng, choice]
+        self.holes[idx] += gaps[rng, choice]
+        self.pieces[idx] += 1
+
+        # clear lines
+        full = self.row_fill[idx] == GRID_WIDTH
+        cleared = full.sum(axis=1)
+        has = cleared > 0
+        if has.any():
+            sub = idx[has]
+            order = np.argsort(~full[has], axis=1, kind="stable")
+            boards = np.take_along_axis(self.boards[sub], order[:, :, None], axis=1)
+            boards &= (np.arange(GRID_HEIGHT)[None, :] >= cleared[has][:, None])[:, :, None]
+            self.boards[sub] = boards
+            self.score[sub] += cleared[has]
+            self._rescan(sub)
+
+        # spawn the next piece
+        next_pid = self.sequences[idx, self.pieces[idx] - 1]
+        self.is_game_over[idx[~self._probe_fits(idx, next_pid)[:, 0]]] = True
+        return True
+
+    def _rescan(self, idx):
+        boards = self.boards[idx]
+        covered = np.logical_or.accumulate(boards, axis=1)
+        self.heights[idx]  = covered.sum(axis=1)
+        self.row_fill[idx] = boards.sum(axis=2)
+        self.holes[idx]    = (covered & ~boards).sum(axis=(1, 2))
+
+    # plays every game to the end, returns the (pieces, score) arrays
+    def run(self, weights):
+        while self.step(weights):
+            pass
+        return (self.pieces, self.score)
+
+# the candidates and probes of a piece code, from the moves get_placements
+# makes on an empty board: every turn it tries is a probe, and so is every
+# column of the row the piece slides along
+def _batch_candidates(code):
+    piece = Shape(SHAPE_IDS[code & 7])
+    if code & 8:
+        piece.rotate()
+    piece.x += MID_WIDTH - piece.h_width()
+    piece.y += GRID_HIDDEN
+    probes = {}
+    def probe(orientation, x, y):
+        return probes.setdefault((tuple(orientation.masks), x, y), (len(probes), orientation, x, y))[0]
+    turns = [probe(piece.orientation(), piece.x, piece.y)]
+    candidates = []
+    seen = []
+    for turn in range(4):
+        if turn > 0:
+            piece.rotate(ROTATION.CLOCKWISE)
+            turns.append(probe(piece.orientation(), piece.x, piece.y))
+        orientation = piece.orientation()
+        if orientation.masks in seen:
+            continue
+        seen.append(orientation.masks)
+        for x in range(GRID_WIDTH - orientation.width + 1):
+            path = turns + [probe(orientation, slide, piece.y) for slide in range(min(x, piece.x), max(x, piece.x) + 1)]
+            candidates.append((piece.rotation, x, piece.y, orientation, path))
+    return (candidates, sorted(probes.values()))
+
+def _build_batch_tables():
+    codes = [shape + turned for shape in range(len(SHAPE_IDS)) for turned in (0, 8)]
+    tables = {code: _batch_candidates(code) for code in codes}
+    count = max(len(tables[code][0]) for code in codes)
+    probes = max(len(tables[code][1]) for code in codes)
+    shape = (16, count)
+    GameBatch.cand_valid  = np.zeros(shape, dtype=bool)
+    # uncovered columns never limit the drop
+    GameBatch.cand_bottom = np.full(shape + (GRID_WIDTH,), -2 * GRID_HEIGHT, dtype=np.int64)
+    GameBatch.cand_top    = np.zeros(shape + (GRID_WIDTH,), dtype=np.int64)
+    GameBatch.cand_cover  = np.zeros(shape + (GRID_WIDTH,), dtype=bool)
+    GameBatch.cand_cells  = np.zeros(shape + (4, GRID_WIDTH), dtype=bool)
+    GameBatch.cand_counts = np.zeros(shape + (4,), dtype=np.int64)
+    GameBatch.cand_rotation = np.zeros(shape, dtype=np.int64)
+    GameBatch.cand_x      = np.zeros(shape, dtype=np.int64)
+    GameBatch.cand_y      = np.zeros(shape, dtype=np.int64)
+    GameBatch.cand_height = np.zeros(shape, dtype=np.int64)
+    GameBatch.cand_path   = np.zeros(shape + (probes,), dtype=bool)
+    GameBatch.probe_y     = np.zeros((16, probes), dtype=np.int64)
+    GameBatch.probe_cells = np.zeros((16, probes, 4, GRID_WIDTH), dtype=bool)
+    GameBatch.probe_never = np.ones((16, probes), dtype=bool)
+    for p in codes:
+        (candidates, probe_list) = tables[p]
+        for c, (rotation, x, y, orientation, path) in enumerate(candidates):
+            GameBatch.cand_valid[p, c] = True
+            GameBatch.cand_rotation[p, c] = rotation
+            GameBatch.cand_x[p, c] = x
+            GameBatch.cand_y[p, c] = y
+            GameBatch.cand_height[p, c] = orientation.height
+            GameBatch.cand_path[p, c, path] = True
+            for dx in range(orientation.width):
+                GameBatch.cand_bottom[p, c, x + dx] = orientation.bottom[dx]
+                GameBatch.cand_top[p, c, x + dx] = orientation.top[dx]
+                GameBatch.cand_cover[p, c, x + dx] = True
+            for (dx, dy) in orientation.cells:
+                GameBatch.cand_cells[p, c, dy, x + dx] = True
+                GameBatch.cand_counts[p, c, dy] += 1
+        for (i, orientation, x, y) in probe_list:
+            GameBatch.probe_y[p, i] = y
+            GameBatch.probe_never[p, i] = not fits([0] * GRID_HEIGHT, orientation, x, y)
+            if not GameBatch.probe_never[p, i]:
+                for (dx, dy) in orientation.cells:
+                    GameBatch.probe_cells[p, i, dy, x + dx] = True
+
+_build_batch_tables()
 
 #****************** ALGO GENE STUFF ***********************
 def random_choose(a, b):
     rnd.randrange(0, 2)
+
+# the factors a gene is made of: (name, feature, sign, default). A factor
+# weights its feature of FEATURES by sign * factor, any registered feature
+# can be added here. Genes of only BASE_FEATURES are scored from the
+# tracked counters and can be played batched
+GENE_SCHEMA = (
+    ("heights_factor",   "aggregate_height", -1, 0.7255915476593505),
+    ("lines_factor",     "full_lines",        1, 1.1750264043234963),
+    ("holes_factor",     "holes",            -1, 0.083118520061818092),
+    ("bumpiness_factor", "bumpiness",        -1, 0.6045332007969104),
+)
+GENE_NAMES = tuple(factor[0] for factor in GENE_SCHEMA)
+GENE_FEATURES = tuple(factor[1] for factor in GENE_SCHEMA)
+GENE_SIGNS = np.array([factor[2] for factor in GENE_SCHEMA], dtype = float)
+GENE_DEFAULTS = np.array([factor[3] for factor in GENE_SCHEMA])
+
+# a numpy generator seeded from the global random module, so a seeded or
+# resumed train() breeds the same genes
+def _numpy_random():
+    return np.random.default_rng(rnd.getrandbits(64))
+
+# factors is a GENE_SCHEMA array and fit the (pieces, score) played, both
+# may be rows of a Population
 class Gene:
-    def __init__(self, mutation=True):
-        self.fit_score    = (0,0)
-        self.heights_factor   = 0.7255915476593505
-        self.lines_factor     = 1.1750264043234963
-        self.holes_factor     = 0.083118520061818092
-        self.bumpiness_factor = 0.6045332007969104
+    __slots__ = ("factors", "fit")
+
+    def __init__(self, mutation=True, factors = None, fit = None):
+        self.factors = GENE_DEFAULTS.copy() if factors is None else factors
+        self.fit = np.zeros(2, dtype = np.int64) if fit is None else fit
         if mutation:
             self.mutate(0.1)
 
+    @property
+    def fit_score(self):
+        return (int(self.fit[0]), int(self.fit[1]))
+
+    @fit_score.setter
+    def fit_score(self, value):
+        self.fit[:] = value
+
+    def factor(self, name):
+        return float(self.factors[GENE_NAMES.index(name)])
+
     def score(self, game):
-        _to_return =  -self.heights_factor    * game.get_aggregate_height()
-        _to_return += self.lines_factor       * game.get_full_lines()
-        _to_return += -self.holes_factor      * game.get_holes()
-        _to_return += - self.bumpiness_factor * game.bumpiness()
-        return _to_return
+        return self.score_features(game.get_features(GENE_FEATURES))
+
+    # GENE_FEATURES values
+    def score_features(self, features):
+        return float(np.dot(features, self.weights()))
+
+    # signed factors, features @ weights gives score_features for every row
+    def weights(self):
+        return self.factors * GENE_SIGNS
 
     def avg_score(self):
-        return self.fit_score[1] / self.fit_score[0]
+        (pieces, score) = self.fit_score
+        return score / pieces
 
+    # every factor from father or mother
     def breed(self, father, mother):
-        self.fit_score    = (0,0)
-        self.heights_factor   = rnd.choice([father.heights_factor, mother.heights_factor])
-        self.lines_factor     = rnd.choice([father.lines_factor, mother.lines_factor])
-        self.holes_factor     = rnd.choice([father.holes_factor, mother.holes_factor])
-        self.bumpiness_factor = rnd.choice([father.bumpiness_factor, mother.bumpiness_factor])
+        self.fit_score = (0, 0)
+        self.factors[:] = np.where(_numpy_random().random(len(GENE_NAMES)) < 0.5, father.factors, mother.factors)
 
     def mutate(self, mutate_ratio):
-        self.heights_factor   += rnd.uniform(-mutate_ratio, mutate_ratio)
-        self.lines_factor     += rnd.uniform(-mutate_ratio, mutate_ratio)
-        self.holes_factor     += rnd.uniform(-mutate_ratio, mutate_ratio)
-        self.bumpiness_factor += rnd.uniform(-mutate_ratio, mutate_ratio)
+        self.factors += _numpy_random().uniform(-mutate_ratio, mutate_ratio, len(GENE_NAMES))
 
     def print(self):
-        print ("heights_factor: " + str(self.heights_factor))
-        print ("lines_factor: " + str(self.lines_factor))
-        print ("holes_factor: " + str(self.holes_factor))
-        print ("bumpiness_factor: " + str(self.bumpiness_factor))
-
+        for (name, value) in zip(GENE_NAMES, self.factors):
+            print (name + ": " + str(value))
+
+    def to_dict(self):
+        data = {name: float(value) for (name, value) in zip(GENE_NAMES, self.factors)}
+        data["fit_score"] = list(self.fit_score)
+        return data
+
+    # factors missing from data, saved before they were added, get their default
+    def from_dict(data):
+        gene = Gene(False)
+        for (i, name) in enumerate(GENE_NAMES):
+            gene.factors[i] = data.get(name, GENE_DEFAULTS[i])
+        gene.fit_score = tuple(data.get("fit_score", (0, 0)))
+        return gene
+
+# a population as one (genes x GENE_NAMES) factors matrix and one (genes x 2)
+# fit matrix, population[i] is a Gene viewing row i of both. dropped marks
+# the genes evaluate_population stopped playing before the last game
+class Population:
+    def __init__(self, factors, fit = None):
+        self.factors = np.array(factors, dtype = float).reshape(-1, len(GENE_NAMES))
+        if fit is None:
+            self.fit = np.zeros((len(self.factors), 2), dtype = np.int64)
+        else:
+            self.fit = np.array(fit, dtype = np.int64).reshape(-1, 2)
+        self.dropped = np.zeros(len(self.factors), dtype = bool)
+
+    # size Gene()s
+    @staticmethod
+    def random(size):
+        return Population(GENE_DEFAULTS + _numpy_random().uniform(-0.1, 0.1, (size, len(GENE_NAMES))))
+
+    @staticmethod
+    def from_genes(genes):
+        return Population([gene.factors for gene in genes], [gene.fit for gene in genes])
+
+    def __len__(self):
+        return len(self.factors)
+
+    def __getitem__(self, i):
+        return Gene(False, self.factors[i], self.fit[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def weights(self):
+        return self.factors * GENE_SIGNS
+
+    # nan for genes that played no game
+    def avg_scores(self):
+        with np.errstate(invalid = "ignore"):
+            return self.fit[:, 1] / self.fit[:, 0]
+
+    # gene indexes, best avg_score first. Dropped genes come after every
+    # gene that played all the games, whatever their avg_score
+    def ranking(self):
+        return np.lexsort((-self.avg_scores(), self.dropped))
+
+    # higher is better, in ranking() order, for breed_factors and the
+    # optimizer backends
+    def fitness(self):
+        fitness = np.empty(len(self))
+        fitness[self.ranking()] = -np.arange(len(self))
+        return fitness
+
+# (genes x features) matrix with one weights() row per gene
+def population_weights(population):
+    if isinstance(population, Population):
+        return population.weights()
+    return np.array([gene.factors for gene in population]) * GENE_SIGNS
 
 def init_genomes(population_size):
-    population = []
-    for i in range(population_size):
-        population = population + [Gene()]
-    return population
-
-#def get_best_moves(game, gene):
-#    return 
-
-
-def get_best_moves(game, gene):
-    start_i = len(game.movements)
-    best_piece = (game.piece, -11011010.0, game.movements)
-    state  =  game.clone()
-    while (state.try_move(MOVEMENT.MOVE_LEFT)):
-        state.move(MOVEMENT.MOVE_LEFT)
-
-    it = state.clone()
-    while it.try_move(MOVEMENT.MOVE_RIGHT):
-        state_1 = it.clone()
-        for rotation in range(4):
-            for _i_ in range(rotation):
-                if state_1.try_move(MOVEMENT.ROTATE_CLOCKWISE):
-                    state_1.move(MOVEMENT.ROTATE_CLOCKWISE)
-            state_2 = state_1.clone()
-            while True:
-                state_3 = state_2.clone()
-                while state_3.try_move(MOVEMENT.MOVE_DOWN):
-                    state_3.move(MOVEMENT.MOVE_DOWN)
-
-                if gene.score(state_3) > best_piece[1]:
-                    best_piece = (copy.deepcopy(state_3.piece), gene.score(state_3), state_3.movements)
-                if state_2.try_move(MOVEMENT.MOVE_RIGHT) == False:
-                    break
-                state_2.move(MOVEMENT.MOVE_RIGHT)
-        it.move(MOVEMENT.MOVE_RIGHT)
-    
-    return (best_piece[0], best_piece[2][start_i:])
+    return Population.random(population_size)
+
+# every final resting position the active piece can reach by turning
+# clockwise where it is, sliding sideways and dropping straight down
+def get_placements(game):
+    placements = []
+    seen = []
+    piece = game.piece.copy()
+    tops = game.column_tops()
+    for turns in range(4):
+        if turns > 0:
+            piece.rotate(ROTATION.CLOCKWISE)
+            if not game.collides(game.rows, piece):
+                break
+        orientation = piece.orientation()
+        # O never changes and I, S, S_2 repeat every 2 turns
+        if orientation.masks in seen:
+            continue
+        seen.append(orientation.masks)
+        left = piece.x
+        while fits(game.rows, orientation, left - 1, piece.y):
+            left -= 1
+        right = piece.x
+        while fits(game.rows, orientation, right + 1, piece.y):
+            right += 1
+        for x in range(left, right + 1):
+            y = drop(game.rows, orientation, x, piece.y, tops)
+            placements.append(Shape(piece.shapeID, piece.rotation, x, y))
+    return placements
+
+# the movements that take the active piece to a placement
+def get_movements(game, placement):
+    piece = game.piece.copy()
+    movements = []
+    while piece.rotation != placement.rotation:
+        piece.rotate(ROTATION.CLOCKWISE)
+        movements.append(MOVEMENT.ROTATE_CLOCKWISE)
+    if placement.x < piece.x:
+        movements += [MOVEMENT.MOVE_LEFT] * (piece.x - placement.x)
+    else:
+        movements += [MOVEMENT.MOVE_RIGHT] * (placement.x - piece.x)
+    movements += [MOVEMENT.MOVE_DOWN] * (placement.y - piece.y)
+    return movements
+
+# (placements x GENE_FEATURES) matrix, one placement_features row per placement
+def get_placement_features(game, placements):
+    if GENE_FEATURES == BASE_FEATURES:
+        return np.array([game.placement_features(piece) for piece in placements], dtype=float)
+    return np.array([game.placement_features(piece, GENE_FEATURES) for piece in placements], dtype=float)
+
+# weights is either one gene's weights() or a population_weights matrix,
+# giving (placements) or (placements x genes) scores
+@timed("score_seconds")
+def score_placements(features, weights):
+    if INSTRUMENT:
+        STATS.values["placements"] += len(features)
+    return features @ np.transpose(weights)
+
+# bounded LRU map, used for (board hash, piece) -> (placements, features)
+class PlacementCache:
+    def __init__(self, max_size = PLACEMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+            self.evictions += 1
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+# get_placements and their get_placement_features, neither depends on the
+# gene so any gene can score a cached entry. The placements are shared,
+# don't change them
+def get_scored_placements(game, cache = None):
+    if cache is None:
+        placements = get_placements(game)
+        return (placements, get_placement_features(game, placements))
+    # the spawn rotation is random, so the piece position is part of the key
+    piece = game.piece
+    key = (game.board_hash, piece.shapeID, piece.rotation, piece.x, piece.y)
+    entry = cache.get(key)
+    if entry is None:
+        placements = get_placements(game)
+        entry = (placements, get_placement_features(game, placements))
+        cache.put(key, entry)
+    return entry
+
+# the placement get_best_moves goes for, to use with Game.place
+@timed("search_seconds")
+def get_best_placement(game, gene, lookahead = None, cache = None, beam_width = None, time_budget = None):
+    if lookahead is None:
+        lookahead = LOOKAHEAD
+    if lookahead:
+        return get_lookahead_placement(game, gene, beam_width, time_budget, cache)
+    (placements, features) = get_scored_placements(game, cache)
+    scores = score_placements(features, gene.weights())
+    return placements[int(np.argmax(scores))]
+
+# two ply search over the current and the next piece. The placements of the
+# current piece are ranked by their own score and only the best beam_width
+# are expanded, in that order, until time_budget seconds have passed. A
+# line cleared by the first piece counts as much as one left for the second.
+# beam_width and time_budget default to BEAM_WIDTH and DECISION_BUDGET
+def get_lookahead_placement(game, gene, beam_width = None, time_budget = None, cache = None):
+    if beam_width is None:
+        beam_width = BEAM_WIDTH
+    if time_budget is None:
+        time_budget = DECISION_BUDGET
+    if time_budget is not None:
+        deadline = time.perf_counter() + time_budget
+    weights = gene.weights()
+    # what a full line is worth to the gene, nothing if its schema has none
+    lines_weight = weights[GENE_FEATURES.index("full_lines")] if "full_lines" in GENE_FEATURES else 0.0
+    (placements, features) = get_scored_placements(game, cache)
+    scores = score_placements(features, weights)
+    beam = np.argsort(-scores, kind="stable")[:beam_width]
+    best = (placements[beam[0]], None)
+    for i in beam:
+        after = game.preview(placements[i])
+        if after.is_game_over:
+            continue
+        second = score_placements(get_scored_placements(after, cache)[1], weights)
+        score = np.max(second) + lines_weight * (after.score - game.score)
+        if best[1] is None or score > best[1]:
+            best = (placements[i], score)
+        if time_budget is not None and time.perf_counter() > deadline:
+            break
+    return best[0]
+
+def get_best_moves(game, gene, lookahead = None, beam_width = None, time_budget = None):
+    best = get_best_placement(game, gene, lookahead, beam_width = beam_width, time_budget = time_budget)
+    return (best, get_movements(game, best))
+
+# get_best_placement without lookahead for every gene of population on the
+# same board, all genes are scored in one matmul
+@timed("search_seconds")
+def get_population_best_placements(game, population, cache = None):
+    (placements, features) = get_scored_placements(game, cache)
+    scores = score_placements(features, population_weights(population))
+    return [placements[i] for i in np.argmax(scores, axis=0)]
+
+# a headless Game dealing from PieceSequence(seed, kind = kind), or random
+# pieces without a seed
+def _new_game(seed, max_pieces, kind):
+    if seed is None:
+        return Game(movement_log = 0)
+    return Game(movement_log = 0, sequence = PieceSequence(seed, max_pieces + 1, kind))
 
 # good seed
 #heights_factor:   0.5255915476593505
@@ -586,69 +1563,1345 @@ def get_best_moves(game, gene):
 #holes_factor:     0.003118520061818092
 #bumpiness_factor: 0.6045332007969104
 
-def survival_of_the_fittest(population):
+# the next size factors rows: the fittest_ratio best of factors by fitness
+# are kept and the rest are their children, every factor from one of two
+# random elite genes and mutated by up to mutate_ratio. The ratios default
+# to FITTEST_RATIO and MUTATE_RATIO
+def breed_factors(factors, fitness, size, fittest_ratio = None, mutate_ratio = None):
+    if fittest_ratio is None:
+        fittest_ratio = FITTEST_RATIO
+    if mutate_ratio is None:
+        mutate_ratio = MUTATE_RATIO
+    ranking = np.argsort(-fitness, kind="stable")
+    number_of_accepted_genes = int(fittest_ratio * len(factors))
+    elite = factors[ranking[:number_of_accepted_genes]]
+    children = size - len(elite)
+    random = _numpy_random()
+    fathers = elite[random.integers(len(elite), size = children)]
+    mothers = elite[random.integers(len(elite), size = children)]
+    child_factors = np.where(random.random(fathers.shape) < 0.5, fathers, mothers)
+    child_factors += random.uniform(-mutate_ratio, mutate_ratio, child_factors.shape)
+    return np.concatenate([elite, child_factors])
+
+# the next generation of population_size genes, POPULATION_SIZE by default
+def survival_of_the_fittest(population, population_size = None, fittest_ratio = None, mutate_ratio = None):
+    if population_size is None:
+        population_size = POPULATION_SIZE
     print ("******survival_of_the_fittest******")
-    population.sort(key=lambda x: x.avg_score(), reverse=True)
-    population[0].print()
-    number_of_accepted_genes = int(FITTEST_RATIO * len(population))
-    elite = population[:number_of_accepted_genes]
-    next_population = copy.deepcopy(elite)
-    for i in range(len(next_population)):
-        next_population[i].fit_score = (0, 0)
-    while len(next_population) < POPULATION_SIZE:
-        father = rnd.choice(elite)
-        mother = rnd.choice(elite)
-        child  = Gene()
-        child.breed(father, mother)
-        child.mutate(MUTATE_RATIO)
-        next_population.append(child)
-    return next_population
-
-def train():
-    population = []
-    #populate
-    for i in range(POPULATION_SIZE):
-        population.append(Gene())
-    for generation_cycle in range(GENERATIONS):
-        print("simulating...")
-        for gene in population:
-            for _a_ in range(1):
-                total = "*" * int(10 * (_a_/TEST_GAMES))
-                total = total + ((10 - len(total)) * "-")
-                print (total, end="\r")
-                game = Game()
-                while (not game.is_game_over) and game.pieces < 300:
-                    best_moves = get_best_moves(game, gene)
-                    moves = best_moves[1]
-                    moves.reverse()
-                    while len(moves) > 0:
-                        move = moves.pop()
-                        assert(game.try_move(move))
-                        game.move(move)
-                    while game.push_down_by_clock() is not True:
-                        pass
-                gene.fit_score = (game.pieces + gene.fit_score[0], game.score + gene.fit_score[1])
-        print("******* GEN " + str(generation_cycle + 1) + " RESULTS **********")
-        for gene in population:
-            print (gene.avg_score())
-        population = survival_of_the_fittest(population)
+    population[population.ranking()[0]].print()
+    return Population(breed_factors(population.factors, population.fitness(), population_size, fittest_ratio, mutate_ratio))
+
+# plays one game with gene, returns (pieces, score). With a ReplayWriter
+# the game is recorded as it is played. max_pieces and the PieceSequence
+# kind default to MAX_PIECES and SEQUENCE, the search settings are those of
+# get_best_placement
+def play_game(gene, seed = None, lookahead = None, cache = None, replay = None, max_pieces = None, kind = None, beam_width = None,
+              time_budget = None):
+    if max_pieces is None:
+        max_pieces = MAX_PIECES
+    if INSTRUMENT:
+        before = STATS.snapshot()
+        start = time.perf_counter()
+    game = _new_game(seed, max_pieces, kind)
+    if replay is not None:
+        replay.start(game, seed)
+    while (not game.is_game_over) and game.pieces < max_pieces:
+        best = get_best_placement(game, gene, lookahead, cache, beam_width, time_budget)
+        game.place(best.rotation, best.x)
+        if replay is not None:
+            replay.piece(game, best.rotation, best.x)
+    if replay is not None:
+        replay.end(game)
+    if INSTRUMENT:
+        seconds = time.perf_counter() - start
+        record = {"event": "game", "seed": seed, "pieces": game.pieces, "score": game.score,
+                  "seconds": seconds, "pieces_per_second": game.pieces / seconds}
+        record.update(STATS.since(before))
+        emit_stats(record)
+    return (game.pieces, game.score)
+
+# plays every gene of genes on seed without lookahead, returns their
+# (pieces, score). Genes whose games are still the same share one Game and
+# get_population_best_placements, the game is cloned where their
+# placements part. With INSTRUMENT one record covers all the genes, pieces
+# is what they played between them and placed the pieces actually placed
+def play_shared_game(genes, seed, cache = None, max_pieces = None, kind = None):
+    if max_pieces is None:
+        max_pieces = MAX_PIECES
+    if INSTRUMENT:
+        before = STATS.snapshot()
+        start = time.perf_counter()
+        placed = 0
+    results = [None] * len(genes)
+    groups = [(_new_game(seed, max_pieces, kind), list(range(len(genes))))]
+    while groups:
+        (game, members) = groups.pop()
+        if game.is_game_over or game.pieces >= max_pieces:
+            for i in members:
+                results[i] = (game.pieces, game.score)
+            continue
+        branches = OrderedDict()
+        for (i, best) in zip(members, get_population_best_placements(game, [genes[i] for i in members], cache)):
+            branches.setdefault((best.rotation, best.x), []).append(i)
+        for (n, ((rotation, x), branch)) in enumerate(branches.items()):
+            child = game if n == len(branches) - 1 else game.clone()
+            child.place(rotation, x)
+            groups.append((child, branch))
+        if INSTRUMENT:
+            placed += len(branches)
+    if INSTRUMENT:
+        seconds = time.perf_counter() - start
+        pieces = sum(result[0] for result in results)
+        record = {"event": "shared_game", "seed": seed, "genes": len(genes), "pieces": pieces,
+                  "score": sum(result[1] for result in results), "placed": placed, "seconds": seconds,
+                  "pieces_per_second": pieces / seconds}
+        record.update(STATS.since(before))
+        emit_stats(record)
+    return results
+
+# the PlacementCache every game played by play_games in this process shares
+_process_cache = None
+
+def process_cache():
+    global _process_cache
+    if _process_cache is None and PLACEMENT_CACHE_SIZE > 0:
+        _process_cache = PlacementCache(PLACEMENT_CACHE_SIZE)
+    return _process_cache
+
+def _play_job(job, lookahead = None, replay_dir = None, max_pieces = None, kind = None, beam_width = None, time_budget = None):
+    return play_game(job[0], job[1], lookahead, process_cache(), process_replay(replay_dir), max_pieces, kind, beam_width,
+                     time_budget)
+
+# _play_job in a pool worker, hands back what the game added to the worker's
+# STATS so the parent can merge it
+def _pooled_play_job(job, lookahead = None, instrument = False, stats_file = None, replay_dir = None, max_pieces = None,
+                     kind = None, beam_width = None, time_budget = None):
+    if not instrument:
+        return (_play_job(job, lookahead, replay_dir, max_pieces, kind, beam_width, time_budget), None)
+    enable_stats(stats_file)
+    before = STATS.snapshot()
+    result = _play_job(job, lookahead, replay_dir, max_pieces, kind, beam_width, time_budget)
+    return (result, STATS.since(before))
+
+# plays gene on every seed, returns the summed (pieces, score) as fit_score
+def _evaluate_gene(gene, seeds, lookahead = None, beam_width = None, time_budget = None):
+    fit_score = (0, 0)
+    for seed in seeds:
+        (pieces, score) = play_game(gene, seed, lookahead, process_cache(), beam_width = beam_width, time_budget = time_budget)
+        fit_score = (fit_score[0] + pieces, fit_score[1] + score)
+    return fit_score
+
+# the module settings pool workers get from the process that made the pool.
+# A spawned worker (Windows, macOS) imports the module afresh and would
+# play with its defaults otherwise
+POOL_SETTINGS = ("MAX_PIECES", "SEQUENCE", "LOOKAHEAD", "BEAM_WIDTH", "DECISION_BUDGET", "PLACEMENT_CACHE_SIZE", "FEATURES",
+                 "GENE_SCHEMA", "GENE_NAMES", "GENE_FEATURES", "GENE_SIGNS", "GENE_DEFAULTS")
+
+# (run, worker) of a pool worker: the pid of the process that made the pool
+# and the worker's index in it, None outside of a worker_pool
+_pool_worker = None
+
+def _init_pool_worker(run, counter, settings):
+    global _pool_worker
+    globals().update(settings)
+    with counter.get_lock():
+        _pool_worker = (run, counter.value)
+        counter.value += 1
+
+# initializer arguments for a pool of _init_pool_worker workers
+def _pool_initargs():
+    return (os.getpid(), multiprocessing.Value("i", 0), {name: globals()[name] for name in POOL_SETTINGS})
+
+# the process pool play_games runs on when workers > 1, train and optimize
+# keep one for their whole run so the workers and their caches live on.
+# Nothing to pool (None) for one worker or when unused
+def worker_pool(workers, unused = False):
+    if workers <= 1 or unused:
+        return contextlib.nullcontext()
+    return multiprocessing.Pool(workers, initializer = _init_pool_worker, initargs = _pool_initargs())
+
+# plays every (gene, seed) job, in one GameBatch if batched or in a process
+# pool if workers > 1 or on the workers of a Coordinator, results come back
+# in job order. With a replay_dir every process records its games there,
+# batched games can't be recorded and a Coordinator's workers record their own.
+# pool is a worker_pool to reuse, one is made for this call if None. Games
+# last up to max_pieces and deal a kind PieceSequence, MAX_PIECES and
+# SEQUENCE by default. lookahead, beam_width and time_budget are those of
+# get_best_placement, batched games don't look ahead
+def play_games(jobs, workers = WORKERS, batched = BATCHED, lookahead = None, replay_dir = None, coordinator = None, pool = None,
+               max_pieces = None, kind = None, beam_width = None, time_budget = None):
+    assert(not (batched and replay_dir is not None))
+    # GameBatch only computes BASE_FEATURES
+    assert(not batched or GENE_FEATURES == BASE_FEATURES)
+    # workers get them with every job
+    if max_pieces is None:
+        max_pieces = MAX_PIECES
+    if kind is None:
+        kind = SEQUENCE
+    if lookahead is None:
+        lookahead = LOOKAHEAD
+    if beam_width is None:
+        beam_width = BEAM_WIDTH
+    if time_budget is None:
+        time_budget = DECISION_BUDGET
+    if coordinator is not None:
+        assert(not batched and replay_dir is None)
+        return coordinator.play(jobs, lookahead, max_pieces, kind, beam_width, time_budget)
+    if batched:
+        batch = GameBatch([job[1] for job in jobs], max_pieces, kind)
+        (pieces, score) = batch.run(population_weights([job[0] for job in jobs]))
+        return list(zip(pieces.tolist(), score.tolist()))
+    if workers > 1:
+        job = functools.partial(_pooled_play_job, lookahead = lookahead, instrument = INSTRUMENT, stats_file = _stats_file,
+                                replay_dir = replay_dir, max_pieces = max_pieces, kind = kind, beam_width = beam_width,
+                                time_budget = time_budget)
+        if pool is None:
+            with worker_pool(workers) as own_pool:
+                results = own_pool.map(job, jobs, chunksize = 1)
+        else:
+            results = pool.map(job, jobs, chunksize = 1)
+        for (result, values) in results:
+            if values is not None:
+                STATS.merge(values)
+        return [result for (result, values) in results]
+    if lookahead or replay_dir is not None:
+        return [_play_job(job, lookahead, replay_dir, max_pieces, kind, beam_width, time_budget) for job in jobs]
+    # the genes playing the same seed share their boards for as long as
+    # they place the same way
+    seeds = OrderedDict()
+    for (i, (gene, seed)) in enumerate(jobs):
+        seeds.setdefault(seed, []).append(i)
+    results = [None] * len(jobs)
+    for (seed, members) in seeds.items():
+        for (i, result) in zip(members, play_shared_game([jobs[i][0] for i in members], seed, process_cache(), max_pieces, kind)):
+            results[i] = result
+    return results
+
+# plays every gene on seeds and adds the results to its fit_score, returns
+# how many games were played. With a Corpus only the SURROGATE_CONFIRM best
+# genes by Corpus.fitness play, the others are dropped and rank last, see
+# Population.ranking. Racing and the screen keep at least the
+# fittest_ratio (FITTEST_RATIO by default) best genes. max_pieces, kind and
+# the search settings go to play_games
+def evaluate_population(population, seeds, workers = WORKERS, batched = BATCHED, lookahead = None, racing = RACING,
+                        replay_dir = None, coordinator = None, corpus = None, pool = None, max_pieces = None, kind = None,
+                        beam_width = None, time_budget = None, fittest_ratio = None):
+    if fittest_ratio is None:
+        fittest_ratio = FITTEST_RATIO
+    round_games = RACE_ROUND if racing else len(seeds)
+    elite = max(int(fittest_ratio * len(population)), 1)
+    # (pieces, score) of every game, per gene
+    games = [[] for gene in population]
+    alive = list(range(len(population)))
+    if corpus is not None:
+        confirm = max(int(SURROGATE_CONFIRM * len(population)), elite)
+        alive = sorted(np.argsort(-corpus.fitness(population), kind="stable")[:confirm].tolist())
+    population.dropped[:] = True
+    population.dropped[alive] = False
+    played = 0
+    for start in range(0, len(seeds), round_games):
+        jobs = []
+        for i in alive:
+            for game_seed in seeds[start:start + round_games]:
+                jobs.append((i, game_seed))
+        results = play_games([(population[i], game_seed) for (i, game_seed) in jobs], workers, batched, lookahead, replay_dir,
+                             coordinator, pool, max_pieces, kind, beam_width, time_budget)
+        for (i, game_seed), (pieces, score) in zip(jobs, results):
+            gene = population[i]
+            gene.fit_score = (pieces + gene.fit_score[0], score + gene.fit_score[1])
+            games[i].append((pieces, score))
+        played += len(jobs)
+        if racing and len(games[alive[0]]) >= 2 and len(alive) > elite:
+            bounds = {}
+            for i in alive:
+                (pieces, score) = np.array(games[i], dtype = float).T
+                # the pooled score / pieces selection ranks by, its standard
+                # error is that of the ratio estimator
+                rate = score.sum() / pieces.sum()
+                residuals = score - rate * pieces
+                error = RACE_Z * np.sqrt(np.sum(residuals ** 2) / (len(pieces) - 1) / len(pieces)) / pieces.mean()
+                bounds[i] = (rate - error, rate + error)
+            cutoff = sorted((bounds[i][0] for i in alive), reverse = True)[elite - 1]
+            alive = [i for i in alive if bounds[i][1] >= cutoff]
+            population.dropped[list(bounds)] = True
+            population.dropped[alive] = False
+    return played
+
+#****************** REPLAY STUFF **************************
+# a replay file is REPLAY_MAGIC followed by 8 byte records, little endian:
+#   b"S" game start  code = sequence kind (index in REPLAY_KINDS), value = seed
+#   b"P" placement   code = piece code of the PieceSequence, rotation, x,
+#                    value = score after the piece locked
+#   b"E" game end    code = 1 if the game was lost, value = pieces
+# the placements of a game follow its start record, its end record is
+# missing if the game never finished. Records are written as the game is
+# played, so a killed run loses at most the record being written
+
+REPLAY_MAGIC = b"TGREPLY1"
+REPLAY_KINDS = ("uniform", "bag")
+REPLAY_RECORD = np.dtype([("tag", "S1"), ("code", "u1"), ("rotation", "u1"), ("x", "i1"), ("value", "<u4")])
+REPLAY_FORMAT = "<cBBbI"
+# records read at a time when ReplayFile looks for the games
+REPLAY_CHUNK = 1 << 20
+
+class ReplayWriter:
+    def __init__(self, path):
+        self.file = open(path, "ab", buffering = 0)
+        if self.file.tell() == 0:
+            self.file.write(REPLAY_MAGIC)
+
+    # only seeded games can be replayed
+    def start(self, game, seed):
+        assert(seed is not None and 0 <= seed < 2 ** 32)
+        self.file.write(struct.pack(REPLAY_FORMAT, b"S", REPLAY_KINDS.index(game.sequence.kind), 0, 0, seed))
+
+    # after game placed a piece at (rotation, x) and brought in the next one
+    def piece(self, game, rotation, x):
+        code = game.sequence.pieces[game.pieces - 2]
+        self.file.write(struct.pack(REPLAY_FORMAT, b"P", code, rotation, x, game.score))
+
+    def end(self, game):
+        self.file.write(struct.pack(REPLAY_FORMAT, b"E", int(game.is_game_over), 0, 0, game.pieces))
+
+    def close(self):
+        self.file.close()
+
+# the ReplayWriter games played by play_games in this process record to,
+# one file per run and worker in replay_dir: replays-<run>-<worker>.bin for
+# pool workers, replays-<pid>.bin for a process outside a pool
+_process_replay = None
+
+def process_replay(replay_dir):
+    global _process_replay
+    if replay_dir is None:
+        return None
+    # a forked worker must not write to its parent's file
+    key = (os.getpid(), replay_dir)
+    if _process_replay is None or _process_replay[0] != key:
+        os.makedirs(replay_dir, exist_ok = True)
+        if _pool_worker is not None:
+            name = "replays-%d-%d.bin" % _pool_worker
+        else:
+            name = "replays-%d.bin" % os.getpid()
+        writer = ReplayWriter(os.path.join(replay_dir, name))
+        _process_replay = (key, writer)
+    return _process_replay[1]
+
+# one recorded game, its placements are a view into the replay file
+class ReplayGame:
+    def __init__(self, records):
+        assert(records[0]["tag"] == b"S")
+        self.seed = int(records[0]["value"])
+        self.kind = REPLAY_KINDS[records[0]["code"]]
+        finished = records[-1]["tag"] == b"E"
+        self.placements = records[1:len(records) - 1] if finished else records[1:]
+        # None when the game never finished
+        self.is_game_over = bool(records[-1]["code"]) if finished else None
+        self.pieces = int(records[-1]["value"]) if finished else len(self.placements) + 1
+        self.score = int(self.placements[-1]["value"]) if len(self.placements) > 0 else 0
+
+    def __len__(self):
+        return len(self.placements)
+
+    # the Game as it was after its first index placements, rebuilt with
+    # Game.place, no search
+    def board(self, index = None):
+        if index is None:
+            index = len(self.placements)
+        assert(0 <= index <= len(self.placements))
+        game = Game(movement_log = 0, sequence = PieceSequence(self.seed, kind = self.kind))
+        for record in self.placements[:index]:
+            assert(game.sequence.pieces[game.pieces - 1] == record["code"])
+            game.place(int(record["rotation"]), int(record["x"]))
+        return game
+
+# a replay file mapped in memory, games are found once when it is opened and
+# read from the file when they are used
+class ReplayFile:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            assert(f.read(len(REPLAY_MAGIC)) == REPLAY_MAGIC)
+        # a record cut short by a killed writer is left out
+        count = (os.path.getsize(path) - len(REPLAY_MAGIC)) // REPLAY_RECORD.itemsize
+        if count > 0:
+            self.records = np.memmap(path, dtype = REPLAY_RECORD, mode = "r", offset = len(REPLAY_MAGIC), shape = (count,))
+        else:
+            self.records = np.zeros(0, dtype = REPLAY_RECORD)
+        starts = []
+        for chunk in range(0, count, REPLAY_CHUNK):
+            starts.append(chunk + np.flatnonzero(self.records["tag"][chunk:chunk + REPLAY_CHUNK] == b"S"))
+        self.starts = np.concatenate(starts) if starts else np.zeros(0, dtype = np.int64)
+        self.stops = np.append(self.starts[1:], count)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return ReplayGame(self.records[self.starts[i]:self.stops[i]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+# every game of a replay file, or of every replay file of a directory
+def read_replays(path):
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".bin")]
+    else:
+        paths = [path]
+    for replay_path in paths:
+        for game in ReplayFile(replay_path):
+            yield game
+
+#****************** DISTRIBUTED STUFF *********************
+# a Coordinator hands out (gene, seed) jobs to run_worker processes on any
+# host over TCP. Messages are json objects, one per line:
+#   worker      {"op": "get", "config": ...}         asks for a job
+#   coordinator {"op": "job", "id", "gene", "seed", "lookahead",
+#                "beam_width", "time_budget", "max_pieces", "sequence"}
+#               {"op": "stop"}                       no more jobs, or an
+#                                                    "error" if the worker's
+#                                                    config doesn't match
+#   worker      {"op": "result", "id", "pieces", "score"}
+# a job is leased to the worker it went to for LEASE_SECONDS. It goes to
+# the next worker asking once the lease runs out or the connection is lost,
+# whichever result comes first is kept
+
+COORDINATOR_PORT = 5123
+LEASE_SECONDS = 120
+# seconds a worker waiting for a job waits before leases are checked again
+LEASE_POLL = 1.0
+
+# the settings a worker must share with the coordinator to play the same
+# games, the rest come with every job
+def _worker_config():
+    return {"gene_schema": [[name, feature, sign] for (name, feature, sign, default) in GENE_SCHEMA]}
+
+def _send(stream, message):
+    stream.write((json.dumps(message) + "\n").encode())
+    stream.flush()
+
+class _CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+# one connected worker, held are the ids of the jobs leased to it
+class _CoordinatorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        coordinator = self.server.coordinator
+        held = set()
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                if message["op"] == "get":
+                    reply = coordinator._lease(message["config"], held)
+                    _send(self.wfile, reply)
+                    if reply["op"] == "stop":
+                        return
+                elif message["op"] == "result":
+                    coordinator._finish(message, held)
+        except (OSError, ValueError):
+            # the worker went away, maybe mid message
+            pass
+        finally:
+            coordinator._release(held)
+
+class Coordinator:
+    def __init__(self, host = "127.0.0.1", port = COORDINATOR_PORT, lease = LEASE_SECONDS):
+        self.lease = lease
+        self.condition = threading.Condition()
+        # jobs without a result yet, in the order they are handed out
+        self.jobs = OrderedDict()
+        # id -> (time the lease runs out, held set of the worker it went to)
+        self.leases = {}
+        self.results = {}
+        self.next_id = 0
+        self.reassigned = 0
+        self.closed = False
+        self.server = _CoordinatorServer((host, port), _CoordinatorHandler)
+        self.server.coordinator = self
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    # waiting workers are told to stop, busy ones once they hand in
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    # plays every (gene, seed) job on the workers, returns (pieces, score)
+    # in job order once all are back
+    def play(self, jobs, lookahead = None, max_pieces = None, kind = None, beam_width = None, time_budget = None):
+        if max_pieces is None:
+            max_pieces = MAX_PIECES
+        if kind is None:
+            kind = SEQUENCE
+        if lookahead is None:
+            lookahead = LOOKAHEAD
+        if beam_width is None:
+            beam_width = BEAM_WIDTH
+        if time_budget is None:
+            time_budget = DECISION_BUDGET
+        with self.condition:
+            ids = []
+            for (gene, seed) in jobs:
+                self.jobs[self.next_id] = {"op": "job", "id": self.next_id, "gene": gene.to_dict(), "seed": seed, "lookahead": lookahead,
+                                           "beam_width": beam_width, "time_budget": time_budget, "max_pieces": max_pieces,
+                                           "sequence": kind}
+                ids.append(self.next_id)
+                self.next_id += 1
+            self.condition.notify_all()
+            while any(i not in self.results for i in ids):
+                self.condition.wait()
+            return [self.results.pop(i) for i in ids]
+
+    # blocks until a job is free, a job is free if it was never leased or
+    # its lease ran out
+    def _lease(self, config, held):
+        with self.condition:
+            if config != _worker_config():
+                return {"op": "stop", "error": "worker config " + str(config) + " is not " + str(_worker_config())}
+            while not self.closed:
+                now = time.monotonic()
+                for (i, job) in self.jobs.items():
+                    if i in self.leases and self.leases[i][0] > now:
+                        continue
+                    if i in self.leases:
+                        self.reassigned += 1
+                    self.leases[i] = (now + self.lease, held)
+                    held.add(i)
+                    return job
+                self.condition.wait(LEASE_POLL)
+            return {"op": "stop"}
+
+    def _finish(self, message, held):
+        with self.condition:
+            i = message["id"]
+            held.discard(i)
+            if i in self.jobs:
+                del self.jobs[i]
+                del self.leases[i]
+                self.results[i] = (message["pieces"], message["score"])
+                self.condition.notify_all()
+
+    # the worker holding held is gone, its jobs are free right away
+    def _release(self, held):
+        with self.condition:
+            for i in held:
+                if i in self.leases and self.leases[i][1] is held:
+                    self.leases[i] = (0, None)
+            self.condition.notify_all()
+
+# plays the jobs of the coordinator at (host, port) until it stops, returns
+# how many games were played. With a replay_dir the games are recorded there
+def run_worker(host = "127.0.0.1", port = COORDINATOR_PORT, replay_dir = None):
+    played = 0
+    with socket.create_connection((host, port)) as connection:
+        stream = connection.makefile("rwb")
+        while True:
+            _send(stream, {"op": "get", "config": _worker_config()})
+            line = stream.readline()
+            if not line:
+                return played
+            message = json.loads(line)
+            if message["op"] == "stop":
+                if "error" in message:
+                    raise RuntimeError(message["error"])
+                return played
+            (pieces, score) = play_game(Gene.from_dict(message["gene"]), message["seed"], message["lookahead"],
+                                        process_cache(), process_replay(replay_dir), message["max_pieces"], message["sequence"],
+                                        message["beam_width"], message["time_budget"])
+            _send(stream, {"op": "result", "id": message["id"], "pieces": pieces, "score": score})
+            played += 1
+
+#****************** CHECKPOINT STUFF **********************
+# one json file per generation, written to a temporary file and renamed so
+# a killed run never leaves a half written checkpoint behind
+
+def _write_atomic(path, text):
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), prefix = ".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+# the population is saved with the fit_scores of generation and the global
+# random state from before survival_of_the_fittest, so resuming breeds the
+# same next generation
+def save_checkpoint(checkpoint_dir, generation, population, config):
+    os.makedirs(checkpoint_dir, exist_ok = True)
+    (version, state, gauss_next) = rnd.getstate()
+    data = {"generation": generation,
+            "config": config,
+            "random_state": [version, list(state), gauss_next],
+            "population": [gene.to_dict() for gene in population],
+            "dropped": np.flatnonzero(population.dropped).tolist()}
+    path = os.path.join(checkpoint_dir, "generation_%04d.json" % generation)
+    _write_atomic(path, json.dumps(data, separators = (",", ":")))
+    return path
+
+def latest_checkpoint(checkpoint_dir):
+    if not os.path.isdir(checkpoint_dir):
+        return None
+    names = sorted(name for name in os.listdir(checkpoint_dir) if name.startswith("generation_") and name.endswith(".json"))
+    if not names:
+        return None
+    return os.path.join(checkpoint_dir, names[-1])
+
+# returns (generation, population, config) and restores the random state
+def load_checkpoint(path):
+    with open(path) as f:
+        data = json.load(f)
+    (version, state, gauss_next) = data["random_state"]
+    rnd.setstate((version, tuple(state), gauss_next))
+    population = Population.from_genes([Gene.from_dict(gene) for gene in data["population"]])
+    population.dropped[data.get("dropped", [])] = True
+    return (data["generation"], population, data["config"])
+
+def export_gene(gene, path):
+    _write_atomic(path, json.dumps(gene.to_dict(), indent = 2))
+
+def load_gene(path):
+    with open(path) as f:
+        return Gene.from_dict(json.load(f))
+
+# the same seed gives the same run whatever the number of workers, games
+# get their seeds from the main process and results are merged in order.
+# Every gene of a generation plays the same games seeds, so genes are
+# ranked on the same pieces. With a checkpoint_dir every generation is saved
+# there along with its best gene, resume carries on from the latest
+# checkpoint with the config it was started with. With a replay_dir every
+# game played is recorded there, see read_replays. With a Coordinator the
+# games are played by its workers instead of workers local processes. With
+# a Corpus genes are screened on it before they play. lookahead, beam_width
+# and time_budget default to LOOKAHEAD, BEAM_WIDTH and DECISION_BUDGET,
+# population_size, mutate_ratio and fittest_ratio to POPULATION_SIZE,
+# MUTATE_RATIO and FITTEST_RATIO
+@profiled
+def train(workers = WORKERS, seed = None, batched = BATCHED, generations = GENERATIONS, lookahead = None, games = TEST_GAMES,
+          checkpoint_dir = None, resume = False, racing = RACING, replay_dir = None, coordinator = None, corpus = None,
+          beam_width = None, time_budget = None, population_size = None, mutate_ratio = None, fittest_ratio = None):
+    if lookahead is None:
+        lookahead = LOOKAHEAD
+    if beam_width is None:
+        beam_width = BEAM_WIDTH
+    if time_budget is None:
+        time_budget = DECISION_BUDGET
+    if population_size is None:
+        population_size = POPULATION_SIZE
+    if mutate_ratio is None:
+        mutate_ratio = MUTATE_RATIO
+    if fittest_ratio is None:
+        fittest_ratio = FITTEST_RATIO
+    config = {"seed": seed, "batched": batched, "lookahead": lookahead, "beam_width": beam_width, "time_budget": time_budget,
+              "games": games, "racing": racing,
+              "sequence": SEQUENCE, "max_pieces": MAX_PIECES, "population_size": population_size,
+              "mutate_ratio": mutate_ratio, "fittest_ratio": fittest_ratio}
+    first_generation = 0
+    checkpoint = None
+    if resume and checkpoint_dir is not None:
+        checkpoint = latest_checkpoint(checkpoint_dir)
+    if checkpoint is not None:
+        (generation, population, config) = load_checkpoint(checkpoint)
+        batched = config["batched"]
+        lookahead = config["lookahead"]
+        beam_width = config.get("beam_width", beam_width)
+        time_budget = config.get("time_budget", time_budget)
+        games = config["games"]
+        racing = config.get("racing", False)
+        population_size = config.get("population_size", population_size)
+        mutate_ratio = config.get("mutate_ratio", mutate_ratio)
+        fittest_ratio = config.get("fittest_ratio", fittest_ratio)
+        print("resuming from " + checkpoint)
+        population = survival_of_the_fittest(population, population_size, fittest_ratio, mutate_ratio)
+        first_generation = generation + 1
+    else:
+        if seed is not None:
+            rnd.seed(seed)
+        #populate
+        population = init_genomes(population_size)
+    max_pieces = config.get("max_pieces", MAX_PIECES)
+    kind = config.get("sequence", SEQUENCE)
+    with worker_pool(workers, batched or coordinator is not None) as pool:
+        for generation_cycle in range(first_generation, generations):
+            print("simulating...")
+            seeds = [rnd.randrange(2 ** 32) for _a_ in range(games)]
+            if INSTRUMENT:
+                before = STATS.snapshot()
+                start = time.perf_counter()
+            played = evaluate_population(population, seeds, workers, batched, lookahead, racing, replay_dir, coordinator,
+                                         corpus, pool, max_pieces, kind, beam_width, time_budget, fittest_ratio)
+            if INSTRUMENT:
+                seconds = time.perf_counter() - start
+                pieces = int(population.fit[:, 0].sum())
+                record = {"event": "generation", "generation": generation_cycle, "games": played, "pieces": pieces,
+                          "seconds": seconds, "pieces_per_second": pieces / seconds}
+                record.update(STATS.since(before))
+                emit_stats(record)
+            print("******* GEN " + str(generation_cycle + 1) + " RESULTS **********")
+            for avg_score in population.avg_scores():
+                print (avg_score)
+            if racing or corpus is not None:
+                print ("saved " + str(len(population) * games - played) + " of " + str(len(population) * games) + " games")
+            if process_cache() is not None and workers <= 1 and not batched:
+                print ("placement cache: " + str(process_cache().stats()))
+            if checkpoint_dir is not None:
+                save_checkpoint(checkpoint_dir, generation_cycle, population, config)
+                export_gene(population[population.ranking()[0]], os.path.join(checkpoint_dir, BEST_GENE_FILE))
+            population = survival_of_the_fittest(population, population_size, fittest_ratio, mutate_ratio)
+    return population
                         
+# runs every job as it is submitted, so a single worker run is repeatable
+class _SerialExecutor:
+    def submit(self, function, *args):
+        future = concurrent.futures.Future()
+        future.set_result(function(*args))
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+def _tournament(population):
+    return max(rnd.sample(population, min(TOURNAMENT_SIZE, len(population))), key=lambda x: x.avg_score())
+
+# steady state evolution: as soon as a gene's games are done it joins the
+# population (replacing the worst gene if it beats it) and a child of two
+# tournament winners goes to the free worker. No worker waits for the rest
+# of a generation. Every gene plays the same games seeds, evaluations is
+# the total number of genes played. With more than one worker the result
+# depends on the order games finish in
+def train_steady_state(workers = WORKERS, seed = None, evaluations = GENERATIONS * POPULATION_SIZE, lookahead = None, games = TEST_GAMES,
+                       beam_width = None, time_budget = None):
+    if seed is not None:
+        rnd.seed(seed)
+    seeds = [rnd.randrange(2 ** 32) for _a_ in range(games)]
+    population = []
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(workers, initializer = _init_pool_worker, initargs = _pool_initargs())
+    else:
+        executor = _SerialExecutor()
+    with executor:
+        running = {}
+        for i in range(min(max(POPULATION_SIZE, workers), evaluations)):
+            gene = Gene()
+            running[executor.submit(_evaluate_gene, gene, seeds, lookahead, beam_width, time_budget)] = (i, gene)
+        submitted = len(running)
+        finished = 0
+        while running:
+            (done, not_done) = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in sorted(done, key=lambda x: running[x][0]):
+                (i, gene) = running.pop(future)
+                gene.fit_score = future.result()
+                finished += 1
+                if len(population) < POPULATION_SIZE:
+                    population.append(gene)
+                else:
+                    worst = min(population, key=lambda x: x.avg_score())
+                    if gene.avg_score() > worst.avg_score():
+                        population[population.index(worst)] = gene
+                if finished % POPULATION_SIZE == 0:
+                    print ("evaluated " + str(finished) + " genes, best " + str(max(x.avg_score() for x in population)))
+                if submitted < evaluations:
+                    child = Gene()
+                    child.breed(_tournament(population), _tournament(population))
+                    child.mutate(MUTATE_RATIO)
+                    running[executor.submit(_evaluate_gene, child, seeds, lookahead, beam_width, time_budget)] = (submitted, child)
+                    submitted += 1
+    population.sort(key=lambda x: x.avg_score(), reverse=True)
+    return population
+
+#****************** OPTIMIZER STUFF ***********************
+# other ways to search the GENE_SCHEMA factors, with the same fitness as
+# train(): lines per piece over the same games for every gene of a
+# generation. Every backend has ask() for the next (genes x factors) matrix
+# to play and tell(factors, fitness) with what they did, sigma is how far
+# it still searches
+
+# starting step size of CrossEntropy and CMAES
+OPTIMIZER_SIGMA = 0.2
+# noise added to the CrossEntropy spread so it doesn't collapse too early
+CEM_NOISE = 0.02
+
+# the GA of train() behind ask/tell
+class GeneticSearch:
+    def __init__(self, mean, size = POPULATION_SIZE):
+        self.factors = mean + _numpy_random().uniform(-0.1, 0.1, (size, len(mean)))
+
+    @property
+    def mean(self):
+        return self.factors.mean(axis = 0)
+
+    @property
+    def sigma(self):
+        return float(self.factors.std(axis = 0).mean())
+
+    def ask(self):
+        return self.factors
+
+    def tell(self, factors, fitness):
+        self.factors = breed_factors(factors, fitness, len(factors))
+
+# cross entropy method: genes are drawn from a normal distribution that is
+# refit to the FITTEST_RATIO best of every generation
+class CrossEntropy:
+    def __init__(self, mean, sigma = OPTIMIZER_SIGMA, size = POPULATION_SIZE, noise = CEM_NOISE):
+        self.mean = np.array(mean, dtype = float)
+        self.std = np.full(len(mean), sigma)
+        self.size = size
+        self.noise = noise
+
+    @property
+    def sigma(self):
+        return float(self.std.mean())
+
+    def ask(self):
+        return self.mean + self.std * _numpy_random().standard_normal((self.size, len(self.mean)))
+
+    def tell(self, factors, fitness):
+        elite = factors[np.argsort(-fitness, kind="stable")[:max(int(FITTEST_RATIO * len(factors)), 1)]]
+        self.mean = elite.mean(axis = 0)
+        self.std = elite.std(axis = 0) + self.noise
+
+# CMA-ES with the default settings of Hansen's tutorial, the best half of
+# every generation moves the mean and adapts the step size and covariance
+class CMAES:
+    def __init__(self, mean, sigma = OPTIMIZER_SIGMA, size = POPULATION_SIZE):
+        n = len(mean)
+        self.mean = np.array(mean, dtype = float)
+        self.sigma = sigma
+        self.size = size
+        mu = size // 2
+        weights = np.log(mu + 0.5) - np.log(np.arange(1, mu + 1))
+        self.weights = weights / weights.sum()
+        self.mueff = 1 / np.sum(self.weights ** 2)
+        self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+        self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+        self.damps = 1 + 2 * max(0, np.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+        # expected length of a standard normal vector
+        self.chin = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.C = np.eye(n)
+        self.B = np.eye(n)
+        self.D = np.ones(n)
+        self.generation = 0
+
+    def ask(self):
+        z = _numpy_random().standard_normal((self.size, len(self.mean)))
+        return self.mean + self.sigma * (z * self.D) @ self.B.T
+
+    def tell(self, factors, fitness):
+        n = len(self.mean)
+        best = np.argsort(-fitness, kind="stable")[:len(self.weights)]
+        y = (factors[best] - self.mean) / self.sigma
+        y_w = self.weights @ y
+        self.mean = self.mean + self.sigma * y_w
+        c_inv_sqrt = self.B @ np.diag(1 / self.D) @ self.B.T
+        self.ps = (1 - self.cs) * self.ps + np.sqrt(self.cs * (2 - self.cs) * self.mueff) * (c_inv_sqrt @ y_w)
+        self.generation += 1
+        ps_norm = np.linalg.norm(self.ps)
+        hsig = ps_norm / np.sqrt(1 - (1 - self.cs) ** (2 * self.generation)) / self.chin < 1.4 + 2 / (n + 1)
+        self.pc = (1 - self.cc) * self.pc + hsig * np.sqrt(self.cc * (2 - self.cc) * self.mueff) * y_w
+        rank_mu = (self.weights[:, None] * y).T @ y
+        rank_one = np.outer(self.pc, self.pc) + (1 - hsig) * self.cc * (2 - self.cc) * self.C
+        self.C = (1 - self.c1 - self.cmu) * self.C + self.c1 * rank_one + self.cmu * rank_mu
+        self.sigma *= np.exp((self.cs / self.damps) * (ps_norm / self.chin - 1))
+        self.C = (self.C + self.C.T) / 2
+        (eigenvalues, self.B) = np.linalg.eigh(self.C)
+        self.D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+
+OPTIMIZERS = {"ga": GeneticSearch, "cem": CrossEntropy, "cma": CMAES}
+
+# runs an OPTIMIZERS backend from the default gene for up to generations,
+# or until the best gene of a generation reaches target lines per piece.
+# Every generation is logged with the pieces played so far, to log_path as
+# json lines when given. With a Corpus the genes are screened on it first,
+# see evaluate_population. Returns the best gene played
+@profiled
+def optimize(optimizer = "cma", workers = WORKERS, seed = None, generations = GENERATIONS, lookahead = None, games = TEST_GAMES,
+             batched = BATCHED, coordinator = None, target = None, log_path = None, corpus = None, beam_width = None, time_budget = None):
+    if seed is not None:
+        rnd.seed(seed)
+    backend = OPTIMIZERS[optimizer](GENE_DEFAULTS)
+    best = None
+    total_pieces = 0
+    with worker_pool(workers, batched or coordinator is not None) as pool:
+        for generation in range(generations):
+            seeds = [rnd.randrange(2 ** 32) for _a_ in range(games)]
+            population = Population(backend.ask())
+            evaluate_population(population, seeds, workers, batched, lookahead, coordinator = coordinator, corpus = corpus,
+                                pool = pool, beam_width = beam_width, time_budget = time_budget)
+            backend.tell(population.factors, population.fitness())
+            total_pieces += int(population.fit[:, 0].sum())
+            leader = population[population.ranking()[0]]
+            if best is None or leader.avg_score() > best.avg_score():
+                best = Gene(False, leader.factors.copy(), leader.fit.copy())
+            # genes that played every game
+            scores = population.avg_scores()[~population.dropped]
+            record = {"event": "optimizer", "optimizer": optimizer, "generation": generation, "pieces": total_pieces,
+                      "best": leader.avg_score(), "mean": float(np.mean(scores)), "sigma": float(backend.sigma),
+                      "factors": [float(value) for value in backend.mean]}
+            print ("gen " + str(generation + 1) + " best " + str(record["best"]) + " mean " + str(record["mean"]) +
+                   " sigma " + str(record["sigma"]) + " pieces " + str(total_pieces))
+            if log_path is not None:
+                with open(log_path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+            if target is not None and record["best"] >= target:
+                break
+    return best
+
+#****************** SURROGATE STUFF ***********************
+# a Corpus is a set of (board, piece) states sampled from games of a
+# reference gene, with the features of every placement the piece has there
+# and the placement the reference went for. Corpus.fitness ranks genes on
+# it without playing, so only the promising ones need full games
+
+# games build_corpus plays and how often it keeps the state, every
+# CORPUS_EVERY pieces
+CORPUS_GAMES = 50
+CORPUS_EVERY = 3
+# states Corpus.fitness scores at a time
+CORPUS_CHUNK = 4096
+# part of the population evaluate_population plays when it has a Corpus
+SURROGATE_CONFIRM = 0.5
+
+class Corpus:
+    # features is (states x placements x FEATURES), padded with invalid
+    # placements up to the piece with most of them, reference_scores are
+    # the reference gene's scores of every placement
+    def __init__(self, names, features, valid, choices, reference_scores):
+        self.names = list(names)
+        self.features = features
+        self.valid = valid
+        self.choices = choices
+        self.reference_scores = reference_scores
+
+    def __len__(self):
+        return len(self.choices)
+
+    def save(self, path):
+        np.savez(path, names = np.array(self.names), features = self.features, valid = self.valid,
+                 choices = self.choices, reference_scores = self.reference_scores)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            return Corpus(data["names"].tolist(), data["features"], data["valid"], data["choices"], data["reference_scores"])
+
+    # one value per gene of population, higher is better. "agreement" is the
+    # part of the states where the gene picks the reference placement,
+    # "regret" minus the mean reference score the gene's picks give away
+    def fitness(self, population, mode = "agreement"):
+        assert(mode == "agreement" or mode == "regret")
+        weights = population_weights(population).astype(np.float32)
+        columns = [self.names.index(name) for name in GENE_FEATURES]
+        total = np.zeros(len(weights))
+        for start in range(0, len(self), CORPUS_CHUNK):
+            stop = min(start + CORPUS_CHUNK, len(self))
+            scores = np.einsum("spf,gf->gsp", self.features[start:stop][:, :, columns], weights)
+            scores[:, ~self.valid[start:stop]] = -np.inf
+            picks = scores.argmax(axis = 2)
+            choices = self.choices[start:stop]
+            if mode == "agreement":
+                total += (picks == choices).sum(axis = 1)
+            else:
+                states = np.arange(stop - start)
+                reference = self.reference_scores[start:stop]
+                total -= (reference[states, choices] - reference[states, picks]).sum(axis = 1)
+        return total / max(len(self), 1)
+
+# the states kept from one game of gene, as (features, choice, reference
+# scores) per state
+def _corpus_game(seed, gene = None, lookahead = None, every = CORPUS_EVERY, beam_width = None, time_budget = None):
+    gene = Gene(False) if gene is None else gene
+    weights = gene.weights()
+    columns = [list(FEATURES).index(name) for name in GENE_FEATURES]
+    states = []
+    game = Game(seed, movement_log = 0)
+    while (not game.is_game_over) and game.pieces < MAX_PIECES:
+        best = get_best_placement(game, gene, lookahead, beam_width = beam_width, time_budget = time_budget)
+        if (game.pieces - 1) % every == 0:
+            placements = get_placements(game)
+            features = np.array([game.placement_features(piece, tuple(FEATURES)) for piece in placements], dtype = float)
+            choice = [(piece.rotation, piece.x, piece.y) for piece in placements].index((best.rotation, best.x, best.y))
+            states.append((features, choice, features[:, columns] @ weights))
+        game.place(best.rotation, best.x)
+    return states
+
+# plays games of gene (the default gene if None) on seeds, CORPUS_GAMES
+# fixed ones by default, and keeps every few states. The placements of
+# the kept states get every registered feature, so the corpus works for
+# any GENE_SCHEMA
+def build_corpus(gene = None, seeds = None, workers = WORKERS, lookahead = None, every = CORPUS_EVERY, beam_width = None,
+                 time_budget = None):
+    if seeds is None:
+        seeds = list(range(CORPUS_GAMES))
+    job = functools.partial(_corpus_game, gene = gene, lookahead = lookahead, every = every, beam_width = beam_width,
+                            time_budget = time_budget)
+    with worker_pool(workers) as pool:
+        if pool is None:
+            games = [job(seed) for seed in seeds]
+        else:
+            games = pool.map(job, seeds, chunksize = 1)
+    states = [state for game in games for state in game]
+    width = max(len(state[0]) for state in states)
+    features = np.zeros((len(states), width, len(FEATURES)), dtype = np.float32)
+    valid = np.zeros((len(states), width), dtype = bool)
+    reference_scores = np.zeros((len(states), width), dtype = np.float32)
+    for (i, (state_features, choice, scores)) in enumerate(states):
+        features[i, :len(state_features)] = state_features
+        valid[i, :len(state_features)] = True
+        reference_scores[i, :len(scores)] = scores
+    choices = np.array([state[1] for state in states], dtype = np.int32)
+    return Corpus(FEATURES.keys(), features, valid, choices, reference_scores)
+
+#****************** SCREEN STUFF **************************
+
+# frames a Screen draws per second at most, the game tick doesn't change it
+RENDER_FPS = 10
+
+# draws Game.frame() in place on an ANSI terminal. The last frame is kept and
+# only the cells that changed since are written, so a frame where nothing
+# moved writes nothing
+class Screen:
+    def __init__(self, fps = RENDER_FPS, out = None):
+        self.out = sys.stdout if out is None else out
+        self.interval = 1.0 / fps if fps else 0.0
+        self.last_frame = None
+        self.last_draw = None
+
+    def __enter__(self):
+        # clear once and hide the cursor, every frame after is a diff
+        self.out.write("\x1b[2J\x1b[H\x1b[?25l")
+        self.out.flush()
+        self.last_frame = []
+        return self
+
+    def __exit__(self, *exc):
+        rows = len(self.last_frame) if self.last_frame else 0
+        self.out.write("\x1b[%d;1H\x1b[?25h\n" % (rows + 1))
+        self.out.flush()
+        return False
+
+    # draws the game if a frame is due, force draws it anyway. Returns
+    # whether it drew
+    def render(self, game, force = False):
+        now = time.perf_counter()
+        if not force and self.last_draw is not None and now - self.last_draw < self.interval:
+            return False
+        self.last_draw = now
+        frame = game.frame()
+        if self.last_frame is None:
+            self.__enter__()
+        self.out.write(self.diff(self.last_frame, frame))
+        self.out.flush()
+        self.last_frame = frame
+        return True
+
+    # the ANSI string that turns old into new, every run of changed cells is
+    # one cursor move and its characters. Lines that got shorter or went away
+    # are blanked
+    @staticmethod
+    def diff(old, new):
+        out = []
+        for y in range(max(len(old), len(new))):
+            before = old[y] if y < len(old) else ""
+            after = new[y] if y < len(new) else ""
+            if before == after:
+                continue
+            size = max(len(before), len(after))
+            before = before.ljust(size)
+            after = after.ljust(size)
+            x = 0
+            while x < size:
+                if before[x] == after[x]:
+                    x += 1
+                    continue
+                start = x
+                while x < size and before[x] != after[x]:
+                    x += 1
+                out.append("\x1b[%d;%dH%s" % (y + 1, start + 1, after[start:x]))
+        return "".join(out)
+
+# non-blocking keyboard, msvcrt on windows, a cbreak terminal polled with
+# select everywhere else. read_key() returns the pressed key as bytes or None
+class Keyboard:
+    def __init__(self):
+        self.fd = None
+        self.saved = None
+
+    def __enter__(self):
+        if msvcrt is None and termios is not None and sys.stdin.isatty():
+            self.fd = sys.stdin.fileno()
+            self.saved = termios.tcgetattr(self.fd)
+            # keys arrive without enter and aren't echoed over the board
+            tty.setcbreak(self.fd)
+            attrs = termios.tcgetattr(self.fd)
+            attrs[3] &= ~termios.ECHO
+            termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+        return self
+
+    def __exit__(self, *exc):
+        if self.saved is not None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
+            self.saved = None
+        self.fd = None
+        return False
+
+    def read_key(self):
+        if msvcrt is not None:
+            return msvcrt.getch() if msvcrt.kbhit() else None
+        if self.fd is None:
+            return None
+        if select.select([self.fd], [], [], 0)[0]:
+            return os.read(self.fd, 1)
+        return None
+
+#****************** SESSION STUFF *************************
+# an asyncio server hosting many AI games in one process. Every session is
+# a seeded Game played by a gene, one piece every SESSION_TICK seconds, the
+# decisions run in an executor so the event loop only moves pieces and
+# talks to clients. Clients connect to a unix socket and send json lines:
+#   {"op": "list"}                          -> {"event": "sessions", ...}
+#   {"op": "start", "gene"?, "seed"?}       -> {"event": "started", ...}
+#   {"op": "subscribe", "session"}          -> {"event": "snapshot", ...}
+#   {"op": "unsubscribe", "session"}
+#   {"op": "stop", "session"}               -> {"event": "stopped", ...}
+# a snapshot has the seed and every placement so far, Game(seed) and
+# Game.place rebuild the board from it. After it subscribers get one
+# {"event": "place"} per piece, with the rows it cleared, and
+# {"event": "over"} when the game is lost or {"event": "stopped"} when the
+# session is stopped. Only the client ends its connection, the server just
+# unsubscribes it
+
+SESSION_SOCKET = os.path.join(tempfile.gettempdir(), "tetris_sessions.sock")
+SESSION_TICK = 0.1
+# bytes a subscriber may fall behind before it is dropped
+SUBSCRIBER_BUFFER = 1 << 20
+
+# the placement gene goes for as (rotation, x, rows it clears)
+def _decide(game, gene, lookahead = None, beam_width = None, time_budget = None):
+    best = get_best_placement(game, gene, lookahead, beam_width = beam_width, time_budget = time_budget)
+    rows = place(game.rows, best.orientation(), best.x, best.y)
+    return (best.rotation, best.x, [y for y in range(GRID_HEIGHT) if rows[y] == FULL_ROW])
+
+class Session:
+    def __init__(self, session_id, gene, seed):
+        self.id = session_id
+        self.gene = gene
+        self.seed = seed
+        self.game = Game(seed, movement_log = 0)
+        self.placements = []
+        # the StreamWriters of the subscribed clients
+        self.subscribers = set()
+        self.task = None
+
+    def summary(self):
+        return {"session": self.id, "seed": self.seed, "pieces": self.game.pieces, "score": self.game.score,
+                "over": self.game.is_game_over}
+
+    def snapshot(self):
+        message = self.summary()
+        message["event"] = "snapshot"
+        message["placements"] = self.placements
+        return message
+
+    # unsubscribes subscribers that are gone or too far behind, their
+    # connection is left to _client
+    def publish(self, message):
+        data = (json.dumps(message) + "\n").encode()
+        for writer in list(self.subscribers):
+            if writer.is_closing() or writer.transport.get_write_buffer_size() > SUBSCRIBER_BUFFER:
+                self.subscribers.discard(writer)
+            else:
+                writer.write(data)
+
+class SessionServer:
+    def __init__(self, executor, tick = SESSION_TICK, lookahead = None, beam_width = None, time_budget = None):
+        self.executor = executor
+        self.tick = tick
+        self.lookahead = lookahead
+        self.beam_width = beam_width
+        self.time_budget = time_budget
+        self.sessions = {}
+        self.next_id = 1
+
+    # needs a running event loop, the default gene if gene is None and a
+    # random seed if seed is None
+    def start_session(self, gene = None, seed = None):
+        if seed is None:
+            seed = rnd.randrange(2 ** 32)
+        session = Session(self.next_id, Gene(False) if gene is None else gene, seed)
+        self.next_id += 1
+        self.sessions[session.id] = session
+        session.task = asyncio.get_running_loop().create_task(self._play(session))
+        return session
+
+    # the subscribers get {"event": "stopped"} and are unsubscribed
+    def stop_session(self, session_id):
+        session = self.sessions.pop(session_id)
+        session.task.cancel()
+        session.publish({"event": "stopped", "session": session.id})
+        session.subscribers.clear()
+
+    async def _play(self, session):
+        loop = asyncio.get_running_loop()
+        game = session.game
+        while not game.is_game_over:
+            (rotation, x, cleared) = await loop.run_in_executor(self.executor, _decide, game, session.gene, self.lookahead,
+                                                                 self.beam_width, self.time_budget)
+            game.place(rotation, x)
+            session.placements.append((rotation, x))
+            session.publish({"event": "place", "session": session.id, "rotation": rotation, "x": x, "cleared": cleared,
+                             "pieces": game.pieces, "score": game.score})
+            await asyncio.sleep(self.tick)
+        session.publish({"event": "over", "session": session.id, "pieces": game.pieces, "score": game.score})
+
+    def _handle(self, message, writer):
+        if not isinstance(message, dict):
+            raise ValueError("not a json object: " + json.dumps(message))
+        op = message["op"]
+        if op == "list":
+            return {"event": "sessions", "sessions": [session.summary() for session in self.sessions.values()]}
+        if op == "start":
+            (gene, seed) = (message.get("gene"), message.get("seed"))
+            if gene is not None and not isinstance(gene, dict):
+                raise ValueError("gene is not a json object: " + json.dumps(gene))
+            if seed is not None and not (isinstance(seed, int) and 0 <= seed < 2 ** 32):
+                raise ValueError("seed is not a 32 bit unsigned int: " + json.dumps(seed))
+            session = self.start_session(None if gene is None else Gene.from_dict(gene), seed)
+            return {"event": "started", "session": session.id, "seed": session.seed}
+        session = self.sessions[message["session"]]
+        if op == "subscribe":
+            session.subscribers.add(writer)
+            return session.snapshot()
+        if op == "unsubscribe":
+            session.subscribers.discard(writer)
+            return None
+        if op == "stop":
+            # a subscriber already got its stopped from stop_session
+            subscribed = writer in session.subscribers
+            self.stop_session(session.id)
+            return None if subscribed else {"event": "stopped", "session": session.id}
+        raise ValueError("unknown op " + str(op))
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # TypeError for a field of the wrong type, like a list session
+                try:
+                    reply = self._handle(json.loads(line), writer)
+                except (ValueError, KeyError, TypeError) as error:
+                    reply = {"event": "error", "error": repr(error)}
+                if reply is not None:
+                    writer.write((json.dumps(reply) + "\n").encode())
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for session in self.sessions.values():
+                session.subscribers.discard(writer)
+            writer.close()
+
+    async def serve(self, path = SESSION_SOCKET):
+        # a socket left behind by a server that died refuses connections,
+        # a running server's socket is left alone
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            with socket.socket(socket.AF_UNIX) as connection:
+                try:
+                    connection.connect(path)
+                except ConnectionRefusedError:
+                    os.remove(path)
+                else:
+                    raise OSError("a server is already listening on " + path)
+        server = await asyncio.start_unix_server(self._client, path)
+        async with server:
+            await server.serve_forever()
+
+# serves sessions AI games of the gene at gene_path (the default gene if
+# None) on a unix socket at path until interrupted, more can be started by
+# clients. Decisions run on workers processes, or on one thread
+def serve_sessions(sessions = 0, gene_path = None, path = SESSION_SOCKET, workers = WORKERS, tick = SESSION_TICK, lookahead = None,
+                   beam_width = None, time_budget = None):
+    gene = None if gene_path is None else load_gene(gene_path)
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(workers, initializer = _init_pool_worker, initargs = _pool_initargs())
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+    async def run():
+        server = SessionServer(executor, tick, lookahead, beam_width, time_budget)
+        for i in range(sessions):
+            server.start_session(gene)
+        await server.serve(path)
+    with executor:
+        asyncio.run(run())
+
+# shows a session of a serve_sessions server, rebuilt from its placements
+def watch(session, path = SESSION_SOCKET):
+    with socket.socket(socket.AF_UNIX) as connection:
+        connection.connect(path)
+        stream = connection.makefile("rwb")
+        _send(stream, {"op": "subscribe", "session": session})
+        game = None
+        with Screen() as screen:
+            for line in stream:
+                message = json.loads(line)
+                if message["event"] == "error":
+                    raise RuntimeError(message["error"])
+                if message["event"] == "snapshot":
+                    game = Game(message["seed"], movement_log = 0)
+                    for (rotation, x) in message["placements"]:
+                        game.place(rotation, x)
+                    if message["over"]:
+                        break
+                elif message["event"] == "place":
+                    game.place(message["rotation"], message["x"])
+                elif message["event"] in ("over", "stopped"):
+                    break
+                screen.render(game)
+            # the stream can end before a snapshot came
+            if game is not None:
+                screen.render(game, force = True)
+
 #****************** MAIN STUFF ****************************
 
-def capture_input():
-    if (msvcrt.kbhit()):
-        _input = msvcrt.getch()
-        if _input.upper() == b'A':
-            return MOVEMENT.MOVE_LEFT
-        elif _input.upper() == b'D':
-            return MOVEMENT.MOVE_RIGHT
-        if _input.upper() == b'S':
-            return MOVEMENT.MOVE_DOWN
-        if _input.upper() == b'Q':
-            return MOVEMENT.ROTATE_COUNTER_CLOCKWISE
-        elif _input.upper() == b'E':
-            return MOVEMENT.ROTATE_CLOCKWISE
-    return None
+KEYS = {
+    b'A': MOVEMENT.MOVE_LEFT,
+    b'D': MOVEMENT.MOVE_RIGHT,
+    b'S': MOVEMENT.MOVE_DOWN,
+    b'Q': MOVEMENT.ROTATE_COUNTER_CLOCKWISE,
+    b'E': MOVEMENT.ROTATE_CLOCKWISE,
+}
+
+def capture_input(keyboard):
+    _input = keyboard.read_key()
+    if _input is None:
+        return None
+    return KEYS.get(_input.upper())
 
 def clear_screen():
     pass
@@ -656,32 +2909,58 @@ def clear_screen():
 
 def main():
     game = Game()
-    while not game.is_game_over:
-        for i in range(10):
-            movement = capture_input()
-            if movement is not None:
-                game.move(movement)
-            game.print()
-            time.sleep(.1)
-        game.push_down_by_clock()
-        game.print()
-
-def ai_play():
-    game = Game()
-    ai = Gene(False)
-    movements = get_best_moves(game, ai)[1]
+    with Keyboard() as keyboard, Screen() as screen:
+        while not game.is_game_over:
+            for i in range(10):
+                movement = capture_input(keyboard)
+                if movement is not None:
+                    game.move(movement)
+                screen.render(game)
+                time.sleep(.1)
+            game.push_down_by_clock()
+            screen.render(game)
+        screen.render(game, force = True)
+
+# gene_path is a gene saved by export_gene, like checkpoints/best_gene.json.
+# With a replay_path the game is appended there as it is played, from seed
+# or from a random one. lookahead, beam_width and time_budget are the search
+# settings get_best_moves uses
+@profiled
+def ai_play(gene_path = None, replay_path = None, seed = None, lookahead = None, beam_width = None, time_budget = None):
+    replay = None
+    if replay_path is not None:
+        replay = ReplayWriter(replay_path)
+        if seed is None:
+            seed = rnd.randrange(2 ** 32)
+    game = Game(seed)
+    ai = Gene(False) if gene_path is None else load_gene(gene_path)
+    if replay is not None:
+        replay.start(game, seed)
+    movements = get_best_moves(game, ai, lookahead, beam_width, time_budget)[1]
     movements.reverse()
-    while not game.is_game_over:
-        for i in range(10):
-            if len(movements) > 0:
-                game.move(movements.pop())
-            game.print()
-            time.sleep(.1)
-        if game.push_down_by_clock():
-            movements = get_best_moves(game, ai)[1]
-            movements.reverse()
-        game.print()
-
-#train()
-#main()
-ai_play()
\ No newline at end of file
+    with Screen() as screen:
+        while not game.is_game_over:
+            for i in range(10):
+                if len(movements) > 0:
+                    game.move(movements.pop())
+                screen.render(game)
+                time.sleep(.1)
+            (rotation, x) = (game.piece.rotation, game.piece.x)
+            if game.push_down_by_clock():
+                if replay is not None:
+                    replay.piece(game, rotation, x)
+                movements = get_best_moves(game, ai, lookahead, beam_width, time_budget)[1]
+                movements.reverse()
+            screen.render(game)
+        screen.render(game, force = True)
+    if replay is not None:
+        replay.end(game)
+        replay.close()
+
+if __name__ == "__main__":
+    #train()
+    #main()
+    #optimize("cma")
+    #serve_sessions(100)
+    #run_worker("coordinator-host")
+    ai_play()
\ No newline at end of file
@@ -0,0 +1,136 @@
+# python -m pytest -q
+import asyncio
+import concurrent.futures
+import json
+import socket
+import threading
+
+import numpy as np
+import pytest
+
+import genetic_algo as ga
+
+SEEDS = [3, 17, 29, 101]
+# short games keep the tests fast
+PIECES = 60
+
+def _genes(count):
+    random = np.random.default_rng(5)
+    return [ga.Gene(False, ga.GENE_DEFAULTS + random.uniform(-0.3, 0.3, len(ga.GENE_NAMES))) for i in range(count)]
+
+@pytest.mark.parametrize("kind", ["uniform", "bag"])
+def test_batch_plays_play_game(kind):
+    genes = _genes(len(SEEDS))
+    (pieces, score) = ga.GameBatch(SEEDS, PIECES, kind).run(ga.population_weights(genes))
+    for (i, (gene, seed)) in enumerate(zip(genes, SEEDS)):
+        assert (int(pieces[i]), int(score[i])) == ga.play_game(gene, seed, max_pieces = PIECES, kind = kind)
+
+# every placement of every state of a game
+def test_feature_deltas_match_full_scan():
+    gene = ga.Gene(False)
+    game = ga.Game(SEEDS[0], movement_log = 0)
+    states = 0
+    while not game.is_game_over and game.pieces < 200:
+        assert game.base_features() == ga.get_features(game.rows)
+        for piece in ga.get_placements(game):
+            locked = ga.place(game.rows, piece.orientation(), piece.x, piece.y)
+            assert game.placement_features(piece) == ga.get_features(locked)
+        best = ga.get_best_placement(game, gene)
+        game.place(best.rotation, best.x)
+        states += 1
+    assert states > 50
+
+def test_resume_matches_uninterrupted_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(ga, "MAX_PIECES", 30)
+    settings = {"seed": 3, "games": 2, "population_size": 4, "racing": True}
+    straight = ga.train(generations = 3, checkpoint_dir = str(tmp_path / "straight"), **settings)
+    ga.train(generations = 1, checkpoint_dir = str(tmp_path / "resumed"), **settings)
+    # resume takes every setting from the checkpoint
+    monkeypatch.setattr(ga, "MAX_PIECES", 80)
+    resumed = ga.train(generations = 3, checkpoint_dir = str(tmp_path / "resumed"), resume = True)
+    assert [gene.to_dict() for gene in resumed] == [gene.to_dict() for gene in straight]
+
+def test_replay_round_trip(tmp_path):
+    gene = _genes(1)[0]
+    path = str(tmp_path / "game.bin")
+    writer = ga.ReplayWriter(path)
+    for seed in SEEDS[:2]:
+        result = ga.play_game(gene, seed, replay = writer, max_pieces = PIECES)
+    writer.close()
+    # the same game played again, one board per placement
+    game = ga.Game(movement_log = 0, sequence = ga.PieceSequence(SEEDS[1], PIECES + 1))
+    boards = [list(game.rows)]
+    while not game.is_game_over and game.pieces < PIECES:
+        best = ga.get_best_placement(game, gene)
+        game.place(best.rotation, best.x)
+        boards.append(list(game.rows))
+    replays = list(ga.read_replays(path))
+    assert [replay.seed for replay in replays] == SEEDS[:2]
+    replay = replays[1]
+    assert (replay.pieces, replay.score, replay.is_game_over) == result + (game.is_game_over,)
+    assert len(replay) == len(boards) - 1
+    for index in (0, len(replay) // 2, len(replay)):
+        assert replay.board(index).rows == boards[index]
+    assert replay.board().score == game.score
+
+# a hand made worker that asked for a job
+def _ask(port, config = None):
+    connection = socket.create_connection(("127.0.0.1", port))
+    stream = connection.makefile("rwb")
+    ga._send(stream, {"op": "get", "config": ga._worker_config() if config is None else config})
+    return (connection, stream)
+
+# a worker that hangs on its job and one that dies with it, their jobs go
+# to the run_worker threads and the results are those of local games
+def test_coordinator_reassigns_lost_jobs(monkeypatch):
+    monkeypatch.setattr(ga, "LEASE_POLL", 0.05)
+    jobs = [(gene, seed) for gene in _genes(2) for seed in SEEDS[:2]]
+    with ga.Coordinator(port = 0, lease = 0.5) as coordinator:
+        port = coordinator.address[1]
+        (hung, hung_stream) = _ask(port)
+        (killed, killed_stream) = _ask(port)
+        results = []
+        player = threading.Thread(target = lambda: results.extend(coordinator.play(jobs, max_pieces = PIECES)))
+        player.start()
+        assert json.loads(hung_stream.readline())["op"] == "job"
+        assert json.loads(killed_stream.readline())["op"] == "job"
+        killed_stream.close()
+        killed.close()
+        workers = [threading.Thread(target = ga.run_worker, args = ("127.0.0.1", port)) for i in range(2)]
+        for worker in workers:
+            worker.start()
+        player.join(30)
+        assert not player.is_alive()
+        assert coordinator.reassigned >= 2
+        # a worker with other settings is turned away
+        (stranger, stranger_stream) = _ask(port, {"gene_schema": []})
+        assert "error" in json.loads(stranger_stream.readline())
+        stranger.close()
+    for worker in workers:
+        worker.join(10)
+        assert not worker.is_alive()
+    hung.close()
+    assert results == [ga.play_game(gene, seed, max_pieces = PIECES) for (gene, seed) in jobs]
+
+# every line that isn't a valid request gets an error and the connection
+# stays usable
+def test_session_server_answers_bad_messages(tmp_path):
+    path = str(tmp_path / "sessions.sock")
+    lines = [b"[1, 2]", b"5", b"not json", b'{"op": "subscribe", "session": [1]}', b'{"op": "start", "gene": 3}',
+             b'{"op": "start", "seed": -1}',
+             b'{"op": "list"}']
+    async def run():
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            server = asyncio.ensure_future(ga.SessionServer(executor).serve(path))
+            while not ga.os.path.exists(path):
+                await asyncio.sleep(0.01)
+            (reader, writer) = await asyncio.open_unix_connection(path)
+            replies = []
+            for line in lines:
+                writer.write(line + b"\n")
+                replies.append(json.loads(await reader.readline()))
+            writer.close()
+            server.cancel()
+            return replies
+    replies = asyncio.run(run())
+    assert [reply["event"] for reply in replies] == ["error"] * (len(lines) - 1) + ["sessions"]